@@ -1,14 +1,40 @@
+import asyncio
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+from contextvars import ContextVar, copy_context
+import json
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
+from fractions import Fraction
+from functools import lru_cache, wraps
+import fcntl
+import hashlib
+import io
+import mmap
 import os
+import random
 import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+import zlib
 from urllib.parse import quote
-from typing import Any, Iterable, Optional, List, Type
+from typing import Any, Iterable, Optional, List
 import importlib
 
-from reretry import retry
+from throttler import Throttler
 
 from XRootD import client
-from XRootD.client.flags import DirListFlags, MkDirFlags, StatInfoFlags
+from XRootD.client.flags import (
+    DirListFlags,
+    MkDirFlags,
+    OpenFlags,
+    QueryCode,
+    StatInfoFlags,
+)
 from XRootD.client.responses import XRootDStatus, StatInfo, DirectoryList
 from XRootD.client import URL
 
@@ -29,27 +55,296 @@ from snakemake_interface_storage_plugins.storage_object import (
     StorageObjectGlob,
 )
 from snakemake_interface_storage_plugins.io import (
+    WILDCARD_REGEX,
     IOCacheStorageInterface,
+    Mtime,
     get_constant_prefix,
 )
 
 
+_NO_MEASUREMENT = nullcontext()
+
+
+# Number of distinct queries whose parsed and decorated URL is remembered
+PARSED_URL_CACHE_SIZE = 100000
+
+
 class XRootDFatalException(Exception):
     """
     Used to prevent retries for certain XRootD errors with the retry decorator
     """
 
 
-def _raise_fatal_error(exception: Type[Exception]) -> None:
-    if isinstance(exception, XRootDFatalException):
-        get_logger().warning("Unrecoverable error, no more retries")
-        raise exception
+class XRootDOverloadError(WorkflowError):
+    """
+    Raised when the server reports that it is overloaded or asks the client to wait
+    """
 
 
-# TODO configurable would be nice
-xrootd_retry = retry(
-    tries=3, delay=3, backoff=2, logger=get_logger(), fail_callback=_raise_fatal_error
-)
+@dataclass
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a failed XRootD operation.
+
+    Delays grow exponentially from delay by the factor backoff up to
+    max_delay, each randomly shortened by up to the fraction jitter so that
+    many failing clients do not retry in lockstep. No attempt is started
+    after deadline seconds (if set) since the first one.
+    """
+
+    tries: int = 3
+    delay: float = 0.5
+    backoff: float = 2.0
+    max_delay: float = 30.0
+    jitter: float = 0.5
+    deadline: Optional[float] = None
+    no_retry_codes: frozenset = frozenset()
+
+    def is_retryable(self, exception: BaseException) -> bool:
+        if isinstance(exception, XRootDFatalException):
+            return False
+        return getattr(exception, "xrootd_errno", None) not in self.no_retry_codes
+
+    def next_delay(
+        self, exception: Exception, attempt: int, elapsed: float
+    ) -> Optional[float]:
+        """
+        Return the delay before the next attempt after attempt (starting at 1)
+        failed, or None if the operation should not be retried.
+        """
+        if attempt >= self.tries or not self.is_retryable(exception):
+            return None
+        delay = min(self.delay * self.backoff ** (attempt - 1), self.max_delay)
+        delay *= 1 - self.jitter * random.random()
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
+# Whether an operation decorated with xrootd_retry is already running in the
+# current thread or task. Nested operations are then attempted only once and
+# leave retries to the outermost one, so that attempts do not multiply.
+_retrying: ContextVar[bool] = ContextVar("_retrying", default=False)
+
+
+def _record_failure(policy: RetryPolicy, exception: Exception, attempt: int, delay):
+    if delay is None:
+        if not policy.is_retryable(exception):
+            get_logger().warning(f"{exception}, unrecoverable error, no more retries")
+        elif policy.tries > 1:
+            get_logger().warning(f"{exception}, attempt {attempt} failed - giving up!")
+        return
+    get_logger().warning(
+        f"{exception}, attempt {attempt}/{policy.tries} failed - "
+        f"retrying in {delay:.2f} seconds..."
+    )
+    # Count the retry if the failed operation was measured.
+    measured = getattr(exception, "xrootd_measured", None)
+    if measured is not None:
+        metrics, operation, endpoint = measured
+        metrics.record_retry(operation, endpoint)
+
+
+def _retry_delay(
+    policy: RetryPolicy, exception: Exception, attempt: int, start: float
+) -> Optional[float]:
+    """Record a failed attempt and return the delay before the next, or None."""
+    delay = policy.next_delay(exception, attempt, time.monotonic() - start)
+    _record_failure(policy, exception, attempt, delay)
+    return delay
+
+
+def xrootd_retry(func):
+    """Retry a StorageObject method according to the provider's retry policy."""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if _retrying.get():
+            return func(self, *args, **kwargs)
+        policy = self.provider._retry_policy
+        token = _retrying.set(True)
+        try:
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    return func(self, *args, **kwargs)
+                except Exception as e:
+                    delay = _retry_delay(policy, e, attempt, start)
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+        finally:
+            _retrying.reset(token)
+
+    return wrapper
+
+
+def xrootd_retry_async(func):
+    """Asynchronous variant of xrootd_retry."""
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if _retrying.get():
+            return await func(self, *args, **kwargs)
+        policy = self.provider._retry_policy
+        token = _retrying.set(True)
+        try:
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    return await func(self, *args, **kwargs)
+                except Exception as e:
+                    delay = _retry_delay(policy, e, attempt, start)
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+        finally:
+            _retrying.reset(token)
+
+    return wrapper
+
+
+def _map_concurrently(func, items: Iterable, workers: int) -> list:
+    """
+    Call func on all items in up to workers threads and return the results in
+    order. Each call runs in a copy of the caller's context, so that nested
+    operations know whether they are retried already.
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(items)), 1)) as executor:
+        futures = [executor.submit(copy_context().run, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+async def _xrootd_call(func, *args, **kwargs) -> tuple[XRootDStatus, Any]:
+    """
+    Await an asynchronous XRootD client call.
+
+    The call is issued with a completion callback, which the XRootD client
+    invokes from its own thread, so the event loop is never blocked.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result):
+        if not future.done():
+            future.set_result(result)
+
+    def callback(status, response, *args):
+        loop.call_soon_threadsafe(set_result, (status, response))
+
+    submit_status = func(*args, callback=callback, **kwargs)
+    if not submit_status.ok:
+        return submit_status, None
+    return await future
+
+
+def _regex_can_match_slash(regex: str) -> bool:
+    """
+    Return whether the given regex can match a '/' anywhere.
+
+    Answers conservatively with True whenever the regex cannot be analysed.
+    """
+    try:
+        from re import _constants as sre, _parser
+
+        slash = ord("/")
+
+        def charset_has_slash(items) -> bool:
+            negate = False
+            found = False
+            for op, av in items:
+                if op is sre.NEGATE:
+                    negate = True
+                elif op is sre.LITERAL:
+                    found |= av == slash
+                elif op is sre.RANGE:
+                    found |= av[0] <= slash <= av[1]
+                elif op is sre.CATEGORY:
+                    found |= av in (
+                        sre.CATEGORY_NOT_DIGIT,
+                        sre.CATEGORY_NOT_SPACE,
+                        sre.CATEGORY_NOT_WORD,
+                        sre.CATEGORY_NOT_LINEBREAK,
+                    )
+                else:
+                    return True
+            return found != negate
+
+        def can_match_slash(subpattern) -> bool:
+            for op, av in subpattern:
+                if op is sre.LITERAL:
+                    matches = av == slash
+                elif op is sre.NOT_LITERAL:
+                    matches = av != slash
+                elif op is sre.IN:
+                    matches = charset_has_slash(av)
+                elif op is sre.BRANCH:
+                    matches = any(can_match_slash(branch) for branch in av[1])
+                elif op is sre.SUBPATTERN:
+                    matches = can_match_slash(av[-1])
+                elif op in (sre.MAX_REPEAT, sre.MIN_REPEAT, sre.POSSESSIVE_REPEAT):
+                    matches = can_match_slash(av[-1])
+                elif op is sre.ATOMIC_GROUP:
+                    matches = can_match_slash(av)
+                elif op in (sre.AT, sre.ASSERT, sre.ASSERT_NOT):
+                    # zero-width, never consumes a character
+                    matches = False
+                else:
+                    matches = True
+                if matches:
+                    return True
+            return False
+
+        return can_match_slash(_parser.parse(regex))
+    except Exception:
+        return True
+
+
+def _compile_segment_matchers(pattern: str) -> List[Optional[re.Pattern]]:
+    """
+    Compile a wildcard pattern into one regex per path segment.
+
+    A segment whose wildcards may match a '/' (the default for wildcards
+    without a constraint) and all segments after it are represented by None,
+    since from there on no directory can be ruled out.
+    """
+    if not pattern:
+        return []
+    segments: List[str] = [""]
+    spans = [False]
+    pos = 0
+    for match in WILDCARD_REGEX.finditer(pattern):
+        literal_parts = pattern[pos : match.start()].split("/")
+        segments[-1] += re.escape(literal_parts[0])
+        for part in literal_parts[1:]:
+            segments.append(re.escape(part))
+            spans.append(False)
+        constraint = match.group("constraint")
+        if constraint is None:
+            # Snakemake's default wildcard regex
+            constraint = ".+"
+        segments[-1] += f"(?:{constraint})"
+        spans[-1] |= _regex_can_match_slash(constraint)
+        pos = match.end()
+    literal_parts = pattern[pos:].split("/")
+    segments[-1] += re.escape(literal_parts[0])
+    for part in literal_parts[1:]:
+        segments.append(re.escape(part))
+        spans.append(False)
+
+    matchers: List[Optional[re.Pattern]] = []
+    for segment, segment_spans in zip(segments, spans):
+        if segment_spans:
+            break
+        matchers.append(re.compile(segment))
+    return matchers + [None] * (len(segments) - len(matchers))
 
 
 @dataclass
@@ -126,42 +421,1618 @@ class StorageProviderSettings(StorageProviderSettingsBase):
             "required": False,
         },
     )
-
-
-class StorageProvider(StorageProviderBase):
-    def __post_init__(self):
-        self.username = self.settings.username
-        self.password = self.settings.password
-        if self.password is not None:
-            get_logger().warning(
-                "A password has been specified -- it will be printed "
-                "in plaintext when Snakemake displays the "
-                "inputs/outputs of jobs! Only use this option in "
-                "trusted environments."
-            )
-        self.host = self.settings.host
-        self.port = self.settings.port
-        # List of error codes that there is no point in retrying
-        self.no_retry_codes = [
-            3000,
-            3001,
-            3002,
-            3006,
-            3008,
-            3009,
-            3010,
-            3011,
-            3013,
-            3017,
-            3021,
-            3025,
-            3030,
-            3031,
-            3032,
-        ]
-        self.dec_func = None
-        if self.settings.url_decorator is not None:
-            self.dec_func = self.load_decorator()
+    remove_workers: int = field(
+        default=16,
+        metadata={
+            "help": (
+                "Number of files or directories removed concurrently when "
+                "removing a directory recursively."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    remove_max_entries: Optional[int] = field(
+        default=100000,
+        metadata={
+            "help": (
+                "Refuse to remove directories containing more than this many "
+                "files and subdirectories. Guards against accidentally deleting "
+                "large trees. Unlimited if unset."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    remove_dry_run: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Only log which files and directories would be removed instead "
+                "of removing them."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    glob_workers: int = field(
+        default=16,
+        metadata={
+            "help": (
+                "Number of directories listed concurrently when calling "
+                "`glob_wildcards`."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    host_max_requests_per_second: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Per-endpoint overrides of the maximum number of requests per "
+                "second, as comma-separated 'host=rate' or 'host:port=rate' "
+                "entries, e.g. 'eosuser.cern.ch=50,localhost:1094=100'. "
+                "Endpoints without an entry use max_requests_per_second."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    adaptive_rate_limit: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Halve the request rate of an endpoint whenever its server "
+                "reports to be overloaded or times out, and raise it again "
+                "step by step (up to the configured rate) after successful "
+                "requests."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    metadata_cache_ttl: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Enable a persistent cache of stat and directory listing results "
+                "that is shared across Snakemake invocations, and keep entries "
+                "for this many seconds. Objects that were found to be missing "
+                "are never cached, and uploads and deletions performed by the "
+                "plugin invalidate the affected entries."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    metadata_cache_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Location of the persistent metadata cache database. Defaults "
+                "to a file in the local storage prefix."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    max_connections: int = field(
+        default=64,
+        metadata={
+            "help": (
+                "Maximum number of XRootD client handles kept open at the same "
+                "time. Handles are shared by all storage objects on the same "
+                "endpoint and the least recently used one is closed when the "
+                "limit is reached."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    connection_idle_timeout: float = field(
+        default=300.0,
+        metadata={
+            "help": (
+                "Number of seconds after which an unused XRootD client handle "
+                "is closed."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    transfer_batch_size: int = field(
+        default=1,
+        metadata={
+            "help": (
+                "Maximum number of concurrently requested downloads/uploads that "
+                "are grouped into a single XRootD copy process. A value of 1 "
+                "disables batching."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    transfer_parallel: int = field(
+        default=4,
+        metadata={
+            "help": "Number of copy jobs of a batch that run in parallel.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    transfer_batch_linger: float = field(
+        default=0.05,
+        metadata={
+            "help": (
+                "Number of seconds to wait for further transfers before starting "
+                "a batch that is not yet full."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    metrics: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Record counts, latencies, retries, transferred bytes and error "
+                "codes of all XRootD operations per endpoint and log a summary "
+                "when Snakemake exits."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    metrics_sink: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Entry point to a function (e.g. 'module:func') that is called "
+                "for every measured operation with the arguments operation, "
+                "endpoint, seconds, nbytes and error (None on success). "
+                "Implies metrics."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    skip_unchanged_transfers: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Skip downloads and uploads if the target already exists with "
+                "the same size and checksum as the source. The remote checksum "
+                "is queried from the server, so it has to support checksum "
+                "queries with the algorithm given by checksum_type."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    checksum_type: str = field(
+        default="adler32",
+        metadata={
+            "help": (
+                "Checksum algorithm used to compare local and remote files, "
+                "either adler32 or md5."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    retry_tries: int = field(
+        default=3,
+        metadata={
+            "help": (
+                "Maximum number of attempts of an XRootD operation. Errors that "
+                "cannot be resolved by retrying (e.g. missing files or missing "
+                "permissions) are never retried."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    retry_delay: float = field(
+        default=0.5,
+        metadata={
+            "help": "Seconds to wait before the first retry.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    retry_backoff: float = field(
+        default=2.0,
+        metadata={
+            "help": "Factor by which the delay grows with each retry.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    retry_max_delay: float = field(
+        default=30.0,
+        metadata={
+            "help": "Maximum number of seconds to wait between two attempts.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    retry_jitter: float = field(
+        default=0.5,
+        metadata={
+            "help": (
+                "Fraction by which each delay is randomly shortened, so that "
+                "clients failing at the same time do not retry at the same time."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    retry_deadline: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Seconds after the first attempt of an operation after which no "
+                "further attempts are started."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    third_party_copy: bool = field(
+        default=True,
+        metadata={
+            "help": (
+                "Let the servers copy directly between XRootD endpoints in "
+                "StorageObject.copy_to(). If the servers refuse, or if this is "
+                "disabled, the file is copied through the local storage prefix."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    node_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of a cache of downloaded files that is shared by all "
+                "jobs on a node. Files are downloaded into the cache once and "
+                "hard linked (or copied, if that is not possible) to the local "
+                "paths of the jobs. Disabled if unset."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    node_cache_max_bytes: int = field(
+        default=100 * 1024**3,
+        metadata={
+            "help": (
+                "Size budget of the node cache in bytes. The least recently "
+                "used files are evicted when it is exceeded."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    bulk_dirlist_threshold: int = field(
+        default=3,
+        metadata={
+            "help": (
+                "Minimum number of queries with the same parent directory for "
+                "which StorageProvider.stat_many() lists the directory instead "
+                "of checking each query individually."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    directory_transfer_batch_size: int = field(
+        default=100,
+        metadata={
+            "help": (
+                "Number of files of a directory input or output that are "
+                "transferred by a single XRootD copy process, with "
+                "transfer_parallel of them running in parallel."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    optimistic_mkdir: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Create the parent directory of uploaded files without checking "
+                "whether it exists first, treating an already existing directory "
+                "as success. Saves a round trip per directory that does not "
+                "exist yet."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    resumable_transfers: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Make downloads and uploads resumable. Files are transferred to "
+                "a temporary name next to the target and renamed when complete, "
+                "and the progress is recorded in the local storage prefix, so "
+                "that retries and later attempts continue where an interrupted "
+                "transfer stopped."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    prefetch_max_bytes: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Enable downloading files in the background before they are "
+                "retrieved (see StorageProvider.prefetch()), keeping at most "
+                "this many bytes of prefetched files that have not been "
+                "retrieved yet in the local storage prefix."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    prefetch_workers: int = field(
+        default=4,
+        metadata={
+            "help": "Number of files that are prefetched concurrently.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    prefetch_on_inventory: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Prefetch every existing file for which Snakemake requests an "
+                "inventory. Note that this includes existing outputs that may "
+                "never be retrieved."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    small_file_threshold: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Upload files smaller than this many bytes with a single write "
+                "through a reused XRootD file handle instead of a copy process, "
+                "creating missing parent directories on the fly. Saves most of "
+                "the per-file overhead for many small outputs. Disabled if "
+                "unset."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    parallel_download_threshold: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Download files of at least this many bytes in chunks over "
+                "several parallel streams instead of a single copy job, and "
+                "verify the result with the checksum reported by the server "
+                "(see checksum_type). Disabled if unset."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    parallel_download_streams: int = field(
+        default=4,
+        metadata={
+            "help": "Number of parallel streams used for chunked downloads.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    parallel_download_chunk_size: int = field(
+        default=64 * 1024 * 1024,
+        metadata={
+            "help": "Size in bytes of the chunks of chunked downloads.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    stream_block_size: int = field(
+        default=1024 * 1024,
+        metadata={
+            "help": (
+                "Size in bytes of the blocks fetched by remote files opened "
+                "with StorageObject.open_remote(). At most 2097136."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+    stream_cache_blocks: int = field(
+        default=64,
+        metadata={
+            "help": "Number of blocks each remote file keeps in memory.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    stream_read_ahead: int = field(
+        default=2,
+        metadata={
+            "help": (
+                "Number of blocks following a read that remote files fetch in "
+                "the same request."
+            ),
+            "env_var": False,
+            "required": False,
+        },
+    )
+
+
+@dataclass
+class _ThrottledBlock:
+    throttler: "AdaptiveThrottler"
+    overloaded: bool = False
+    token: Any = None
+
+
+# The block guarded by an AdaptiveThrottler in the current task or thread, so
+# that overloads are reported to it as they happen, also when a retry inside
+# the block recovers from them.
+_throttled_block: ContextVar[Optional[_ThrottledBlock]] = ContextVar(
+    "_throttled_block", default=None
+)
+
+
+def _report_overload():
+    block = _throttled_block.get()
+    if block is not None:
+        block.overloaded = True
+        block.throttler.overloaded()
+
+
+class AdaptiveThrottler:
+    """
+    Async context manager limiting the request rate of one endpoint.
+
+    The rate starts at max_rate. It is halved (down to min_rate) for every
+    overload reported while a guarded block runs, or if the block raises an
+    XRootDOverloadError, and raised by a fixed step after each block that
+    succeeded without overloads, up to max_rate again.
+    """
+
+    def __init__(
+        self,
+        max_rate: float,
+        min_rate: Optional[float] = None,
+        increase_step: Optional[float] = None,
+        clock=time.monotonic,
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate is not None else max_rate / 64
+        self.increase_step = (
+            increase_step if increase_step is not None else max_rate / 20
+        )
+        self.rate = max_rate
+        self._clock = clock
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        now = self._clock()
+        wait = self._next_slot - now
+        self._next_slot = max(now, self._next_slot) + 1 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+        block = _ThrottledBlock(self)
+        block.token = _throttled_block.set(block)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        block = _throttled_block.get()
+        _throttled_block.reset(block.token)
+        if block.overloaded:
+            # The rate has been lowered when the overloads were reported.
+            return
+        if isinstance(exc_val, XRootDOverloadError):
+            self.overloaded()
+        elif exc_val is None:
+            self.rate = min(self.rate + self.increase_step, self.max_rate)
+
+    def overloaded(self):
+        """Halve the rate after the endpoint reported an overload."""
+        self.rate = max(self.rate / 2, self.min_rate)
+
+
+class SingleFlight:
+    """
+    Lets concurrent calls with the same key share a single execution.
+
+    The first caller runs the function, callers arriving while it is still
+    running wait for it and receive the same result or exception. Results
+    are not kept, a call after the running one has finished runs again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Any, Future] = {}
+        self._async_calls: dict[Any, asyncio.Future] = {}
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key, func):
+        """
+        Like do() for the coroutine function func. Calls are shared among the
+        tasks of an event loop.
+        """
+        key = (asyncio.get_running_loop(), key)
+        future = self._async_calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Without waiters, nobody else retrieves the exception
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._async_calls[key]
+
+
+class FileSystemPool:
+    """
+    Lazily created XRootD FileSystem handles, shared per endpoint.
+
+    Endpoints are identified by protocol, credentials, host, port and URL
+    parameters. The pool holds at most max_size handles and drops handles
+    that have not been used for idle_timeout seconds.
+    """
+
+    def __init__(self, max_size: int, idle_timeout: float, clock=time.monotonic):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        # endpoint -> (file system, time of last use), least recently used first
+        self._handles: OrderedDict[str, tuple[client.FileSystem, float]] = OrderedDict()
+
+    def get(self, endpoint: str) -> client.FileSystem:
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._handles.pop(endpoint, None)
+            file_system = client.FileSystem(endpoint) if entry is None else entry[0]
+            self._handles[endpoint] = (file_system, now)
+            while len(self._handles) > max(self.max_size, 1):
+                self._handles.popitem(last=False)
+            return file_system
+
+    def _evict_idle(self, now: float):
+        while self._handles:
+            _, last_used = next(iter(self._handles.values()))
+            if now - last_used <= self.idle_timeout:
+                break
+            self._handles.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0, float("inf"))
+
+
+@dataclass
+class OperationStats:
+    count: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    nbytes: int = 0
+    errors: Counter = field(default_factory=Counter)
+    # Number of calls with a latency up to the corresponding LATENCY_BUCKETS bound
+    histogram: List[int] = field(default_factory=lambda: [0] * len(LATENCY_BUCKETS))
+
+
+class Measurement:
+    """Context manager timing a single operation, see XRootDMetrics.measure."""
+
+    __slots__ = ("metrics", "operation", "endpoint", "nbytes", "_start")
+
+    def __init__(self, metrics: "XRootDMetrics", operation: str, endpoint: str):
+        self.metrics = metrics
+        self.operation = operation
+        self.endpoint = endpoint
+        self.nbytes = 0
+
+    def __enter__(self) -> "Measurement":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        error = None
+        if exc is not None:
+            error = getattr(exc, "xrootd_errno", None) or exc_type.__name__
+            try:
+                exc.xrootd_measured = (self.metrics, self.operation, self.endpoint)
+            except AttributeError:
+                pass
+        self.metrics.record(
+            self.operation,
+            self.endpoint,
+            time.perf_counter() - self._start,
+            self.nbytes,
+            error,
+        )
+        return False
+
+
+class XRootDMetrics:
+    """
+    Statistics of XRootD operations per (operation, endpoint).
+
+    Errors are counted by XRootD errno, or by exception type for errors that
+    did not come from the server. If a sink is given, it is called for every
+    recorded operation.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self.stats: dict[tuple[str, str], OperationStats] = {}
+
+    def measure(self, operation: str, endpoint: str) -> Measurement:
+        return Measurement(self, operation, endpoint)
+
+    def _get(self, operation: str, endpoint: str) -> OperationStats:
+        stats = self.stats.get((operation, endpoint))
+        if stats is None:
+            stats = self.stats[(operation, endpoint)] = OperationStats()
+        return stats
+
+    def record(
+        self,
+        operation: str,
+        endpoint: str,
+        seconds: float,
+        nbytes: int = 0,
+        error: Any = None,
+    ):
+        with self._lock:
+            stats = self._get(operation, endpoint)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.nbytes += nbytes
+            if error is not None:
+                stats.errors[error] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats.histogram[i] += 1
+                    break
+        if self.sink is not None:
+            self.sink(operation, endpoint, seconds, nbytes, error)
+
+    def record_retry(self, operation: str, endpoint: str):
+        with self._lock:
+            self._get(operation, endpoint).retries += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = []
+            for (operation, endpoint), stats in sorted(self.stats.items()):
+                line = (
+                    f"{operation} {endpoint}: {stats.count} calls, "
+                    f"{stats.seconds:.3f}s total, "
+                    f"{stats.seconds / max(stats.count, 1) * 1000:.1f}ms mean, "
+                    f"{stats.retries} retries"
+                )
+                if stats.nbytes:
+                    line += (
+                        f", {stats.nbytes} bytes "
+                        f"({stats.nbytes / max(stats.seconds, 1e-9) / 1e6:.1f} MB/s)"
+                    )
+                if stats.errors:
+                    errors = ", ".join(
+                        f"{error}: {n}" for error, n in stats.errors.most_common()
+                    )
+                    line += f", errors {{{errors}}}"
+                histogram = " ".join(
+                    f"<={bound:g}s:{n}"
+                    for bound, n in zip(LATENCY_BUCKETS, stats.histogram)
+                    if n
+                )
+                lines.append(f"{line}, latency {histogram}")
+            return "\n".join(lines)
+
+    def log_summary(self):
+        summary = self.summary()
+        if summary:
+            get_logger().info(f"XRootD operation metrics:\n{summary}")
+
+
+class _Adler32:
+    """hashlib-like wrapper around zlib.adler32."""
+
+    def __init__(self):
+        self.value = 1
+
+    def update(self, data: bytes):
+        self.value = zlib.adler32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+CHECKSUM_ALGORITHMS = {"adler32": _Adler32, "md5": hashlib.md5}
+
+
+class LocalChecksumCache:
+    """
+    Checksums of local files, keyed by path, size and modification time.
+
+    Files are read in blocks of block_size bytes, so memory use does not
+    depend on the file size. At most max_size checksums are kept.
+    """
+
+    def __init__(self, max_size: int = 10000, block_size: int = 4 * 1024 * 1024):
+        self.max_size = max_size
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._checksums: OrderedDict[tuple, str] = OrderedDict()
+
+    def get(self, path: str, algorithm: str) -> str:
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns, algorithm)
+        with self._lock:
+            if key in self._checksums:
+                self._checksums.move_to_end(key)
+                return self._checksums[key]
+        checksum = CHECKSUM_ALGORITHMS[algorithm]()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(self.block_size), b""):
+                checksum.update(block)
+        value = checksum.hexdigest()
+        with self._lock:
+            self._checksums[key] = value
+            while len(self._checksums) > max(self.max_size, 1):
+                self._checksums.popitem(last=False)
+        return value
+
+
+@dataclass
+class CachedStatInfo:
+    size: int
+    modtime: float
+    flags: int
+
+
+@dataclass
+class CachedListEntry:
+    name: str
+    statinfo: Optional[CachedStatInfo]
+
+
+@dataclass
+class CachedDirectoryList:
+    dirlist: List[CachedListEntry]
+
+
+class MetadataCache:
+    """
+    Persistent SQLite cache of stat and dirlist results.
+
+    Entries are keyed by the URL of the object without credentials and
+    parameters and are considered stale after ttl seconds. Storing a directory
+    listing also stores the stat results of all its entries. Database errors
+    (e.g. a lock held by another process for too long) are logged and treated
+    as cache misses.
+    """
+
+    def __init__(self, path: str, ttl: float, clock=time.time):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS stat "
+                "(key TEXT PRIMARY KEY, size INTEGER, modtime REAL, flags INTEGER, "
+                "fetched REAL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dirlist "
+                "(key TEXT PRIMARY KEY, entries TEXT, fetched REAL)"
+            )
+
+    def _query(self, sql: str, args: tuple) -> Optional[tuple]:
+        try:
+            with self._lock:
+                return self._db.execute(sql, args).fetchone()
+        except sqlite3.Error as e:
+            get_logger().debug(f"XRootD metadata cache read failed: {e}")
+            return None
+
+    def _write(self, sql: str, rows: List[tuple]):
+        try:
+            with self._lock, self._db:
+                self._db.executemany(sql, rows)
+        except sqlite3.Error as e:
+            get_logger().debug(f"XRootD metadata cache write failed: {e}")
+
+    def _count(self, found: bool):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get_stat(self, key: str) -> Optional[CachedStatInfo]:
+        row = self._query(
+            "SELECT size, modtime, flags FROM stat WHERE key = ? AND fetched >= ?",
+            (key, self._clock() - self.ttl),
+        )
+        self._count(row is not None)
+        return CachedStatInfo(*row) if row is not None else None
+
+    def put_stat(self, key: str, stat_info: StatInfo):
+        self._write(
+            "INSERT OR REPLACE INTO stat VALUES (?, ?, ?, ?, ?)",
+            [(key, stat_info.size, stat_info.modtime, stat_info.flags, self._clock())],
+        )
+
+    def get_dirlist(self, key: str) -> Optional[CachedDirectoryList]:
+        row = self._query(
+            "SELECT entries FROM dirlist WHERE key = ? AND fetched >= ?",
+            (key, self._clock() - self.ttl),
+        )
+        self._count(row is not None)
+        if row is None:
+            return None
+        return CachedDirectoryList(
+            [
+                CachedListEntry(
+                    name, CachedStatInfo(*stat) if stat is not None else None
+                )
+                for name, stat in json.loads(row[0])
+            ]
+        )
+
+    def put_dirlist(self, key: str, dirlist: DirectoryList):
+        now = self._clock()
+        entries = []
+        stats = []
+        for entry in dirlist.dirlist:
+            stat = None
+            if entry.statinfo is not None:
+                stat = (
+                    entry.statinfo.size,
+                    entry.statinfo.modtime,
+                    entry.statinfo.flags,
+                )
+                stats.append((f"{key.rstrip('/')}/{entry.name}", *stat, now))
+            entries.append((entry.name, stat))
+        self._write(
+            "INSERT OR REPLACE INTO dirlist VALUES (?, ?, ?)",
+            [(key, json.dumps(entries), now)],
+        )
+        self._write("INSERT OR REPLACE INTO stat VALUES (?, ?, ?, ?, ?)", stats)
+
+    def invalidate(self, key: str, recursive: bool = False):
+        """
+        Forget the object and the listings of all directories containing it,
+        and with recursive, everything below it.
+        """
+        self._write("DELETE FROM stat WHERE key = ?", [(key,)])
+        self._write(
+            "DELETE FROM dirlist WHERE key = substr(?, 1, length(key))", [(key,)]
+        )
+        if recursive:
+            prefix = key.rstrip("/") + "/"
+            for table in ("stat", "dirlist"):
+                self._write(
+                    f"DELETE FROM {table} WHERE substr(key, 1, ?) = ?",
+                    [(len(prefix), prefix)],
+                )
+
+
+# Suffix of the temporary names of resumable transfers
+PARTIAL_SUFFIX = ".xrootd-part"
+# Amount of data read or written per request by resumable and chunked transfers
+TRANSFER_PIECE_SIZE = 8 * 1024 * 1024
+# kXR_Unsupported, with which servers may refuse third-party copies
+UNSUPPORTED_ERRNO = 3013
+
+
+class NodeCache:
+    """
+    Cache of downloaded files in a directory shared by processes on a node.
+
+    Entries are identified by a key that changes whenever the remote file
+    changes (e.g. URL, size and modification time). An exclusive file lock per
+    entry makes concurrent processes download each entry only once. Entries
+    are made read-only, since they are hard linked into the local paths, and
+    the least recently used ones are evicted once the total size exceeds
+    max_bytes, together with their lock file. Entries being downloaded or
+    linked are never evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def retrieve(self, key: str, local_path: str, download) -> bool:
+        """
+        Make the entry for key available at local_path, calling
+        download(path) to fill the cache first if necessary. Returns whether
+        the entry had to be downloaded.
+        """
+        path = self._path(key)
+        with self._lock(path):
+            downloaded = not os.path.exists(path)
+            if downloaded:
+                partial_path = path + ".download"
+                try:
+                    download(partial_path)
+                except BaseException:
+                    # Partial downloads are not counted as entries, do not
+                    # leave them behind.
+                    if os.path.lexists(partial_path):
+                        os.remove(partial_path)
+                    raise
+                os.chmod(partial_path, 0o444)
+                os.replace(partial_path, path)
+            else:
+                # Mark as recently used
+                os.utime(path)
+            if os.path.lexists(local_path):
+                os.remove(local_path)
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+            try:
+                os.link(path, local_path)
+            except OSError:
+                shutil.copyfile(path, local_path)
+        if downloaded:
+            self.evict()
+        return downloaded
+
+    @staticmethod
+    def _lock(path: str, blocking: bool = True):
+        """
+        Open and lock the lock file of the entry at path. Returns None if
+        blocking is False and the entry is in use by another process.
+        """
+        while True:
+            lock = open(path + ".lock", "a")
+            try:
+                fcntl.flock(
+                    lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except BlockingIOError:
+                lock.close()
+                return None
+            # evict() may have removed the lock file while we were waiting for
+            # it, the lock is only valid if it is still in place.
+            try:
+                locked, current = os.fstat(lock.fileno()), os.stat(lock.name)
+                if (locked.st_dev, locked.st_ino) == (current.st_dev, current.st_ino):
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _remove(self, path: str) -> bool:
+        """
+        Remove the entry at path with its partial download and lock file
+        unless it is in use.
+        """
+        lock = self._lock(path, blocking=False)
+        if lock is None:
+            return False
+        with lock:
+            for name in (
+                path,
+                path + ".download",
+                path + ".download" + PARTIAL_SUFFIX,
+                path + ".lock",
+            ):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+        return True
+
+    def evict(self):
+        entries = []
+        names = set()
+        for entry in os.scandir(self.directory):
+            names.add(entry.name)
+            if "." in entry.name:
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        # Lock files and partial downloads of entries that were never
+        # completed, e.g. by processes that were killed. Running downloads
+        # hold their lock and are skipped.
+        incomplete = {name.split(".", 1)[0] for name in names if "." in name}
+        for name in incomplete - names:
+            self._remove(os.path.join(self.directory, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                total -= size
+
+
+@dataclass
+class PrefetchEntry:
+    path: str
+    size: int
+    modtime: int
+    future: Optional[Future] = None
+
+
+class Prefetcher:
+    """
+    Downloads files into a staging directory in the background.
+
+    Files are identified by a key (their URL). Scheduling a key that is
+    already being prefetched does nothing, and files whose size would exceed
+    max_bytes together with all prefetched files not taken yet are skipped.
+    take() waits for a prefetch and hands the downloaded file over, unless the
+    remote file changed since it was scheduled.
+    """
+
+    def __init__(self, directory: str, workers: int, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self._entries: dict[str, PrefetchEntry] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix="xrootd-prefetch"
+        )
+
+    def schedule(self, key: str, stat_info: StatInfo, download) -> bool:
+        """
+        Start download(path) in the background unless key is prefetched
+        already. Returns False if the byte budget does not allow it.
+        """
+        with self._lock:
+            if key in self._entries:
+                return True
+            if self.reserved + stat_info.size > self.max_bytes:
+                return False
+            os.makedirs(self.directory, exist_ok=True)
+            entry = PrefetchEntry(
+                os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()),
+                stat_info.size,
+                stat_info.modtime,
+            )
+            self.reserved += entry.size
+            self._entries[key] = entry
+            entry.future = self._executor.submit(
+                copy_context().run, download, entry.path
+            )
+        return True
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def take(self, key: str, stat_info: StatInfo) -> Optional[str]:
+        """
+        Wait for the prefetch of key and return the path of the downloaded
+        file, which then belongs to the caller. Returns None if key is not
+        prefetched, the prefetch failed or the remote file has changed since.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        try:
+            entry.future.result()
+        except Exception as e:
+            get_logger().debug(f"Prefetching failed, downloading again: {e}")
+            self._discard(entry)
+            return None
+        if (entry.size, entry.modtime) != (stat_info.size, stat_info.modtime):
+            self._discard(entry)
+            return None
+        with self._lock:
+            self.reserved -= entry.size
+        return entry.path
+
+    def cancel(self, key: Optional[str] = None):
+        """Cancel the prefetch of key (by default all) and discard its file."""
+        with self._lock:
+            keys = list(self._entries) if key is None else [key]
+            entries = [self._entries.pop(key) for key in keys if key in self._entries]
+        for entry in entries:
+            # Running downloads cannot be interrupted, their file is removed
+            # once they finish.
+            entry.future.cancel()
+            entry.future.add_done_callback(lambda _, entry=entry: self._discard(entry))
+
+    def _discard(self, entry: PrefetchEntry):
+        with self._lock:
+            self.reserved -= entry.size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TransferProgress:
+    """
+    Progress of a transfer, optionally persisted in a JSON sidecar file.
+
+    The progress is tied to an identity (e.g. the size and modification time
+    of the source). load() returns the recorded state only if it belongs to
+    the same identity and an empty state otherwise. Without a path, the
+    progress only lives as long as this object.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._identity = None
+        self._state = {}
+
+    def load(self, identity: dict) -> dict:
+        if self._identity != identity:
+            self._identity = identity
+            self._state = {}
+            if self.path is not None:
+                try:
+                    with open(self.path) as f:
+                        record = json.load(f)
+                    if record.get("identity") == identity:
+                        self._state = record.get("state", {})
+                except (OSError, ValueError):
+                    pass
+        return self._state
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"identity": self._identity, "state": self._state}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self._identity = None
+        self._state = {}
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+# Limits of a single vector read request of the XRootD protocol
+MAX_VECTOR_READ_CHUNKS = 1024
+MAX_VECTOR_READ_CHUNK_SIZE = 2097136
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only file-like object reading a remote file on demand.
+
+    The file is read in blocks of block_size bytes that are fetched with
+    vector reads, together with up to read_ahead following blocks, and kept in
+    an LRU cache of cache_blocks blocks. read_ranges() fetches many scattered
+    ranges at once. bytes_fetched counts the bytes transferred from the server.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        check_status,
+        error_preamble: str,
+        block_size: int = 1024 * 1024,
+        cache_blocks: int = 64,
+        read_ahead: int = 2,
+    ):
+        super().__init__()
+        self.block_size = min(max(block_size, 1), MAX_VECTOR_READ_CHUNK_SIZE)
+        self.cache_blocks = max(cache_blocks, 1)
+        self.read_ahead = max(read_ahead, 0)
+        self.bytes_fetched = 0
+        self._check_status = check_status
+        self._error_preamble = error_preamble
+        self._lock = threading.Lock()
+        self._blocks: OrderedDict[int, bytes] = OrderedDict()
+        self._position = 0
+        self._file = client.File()
+        status, _ = self._file.open(url, OpenFlags.READ)
+        self._check_status(status, self._error_preamble)
+        status, stat_info = self._file.stat()
+        self._check_status(status, self._error_preamble)
+        self.size = stat_info.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        data = self.read_ranges([(self._position, len(buffer))])[0]
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def read_ranges(self, ranges: List[tuple[int, int]]) -> List[bytes]:
+        """Read the given (offset, length) ranges, fetching missing blocks at once."""
+        ranges = [
+            (offset, max(min(length, self.size - offset), 0))
+            for offset, length in ranges
+        ]
+        with self._lock:
+            self._fetch(
+                {
+                    block
+                    for offset, length in ranges
+                    if length > 0
+                    for block in range(
+                        offset // self.block_size,
+                        (offset + length - 1) // self.block_size + 1,
+                    )
+                }
+            )
+            result = [self._assemble(offset, length) for offset, length in ranges]
+            while len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+            return result
+
+    def _assemble(self, offset: int, length: int) -> bytes:
+        parts = []
+        end = offset + length
+        while offset < end:
+            block, start = divmod(offset, self.block_size)
+            data = self._blocks[block]
+            self._blocks.move_to_end(block)
+            part = data[start : start + end - offset]
+            parts.append(part)
+            offset += len(part)
+        return b"".join(parts)
+
+    def _fetch(self, blocks: set[int]):
+        missing = sorted(block for block in blocks if block not in self._blocks)
+        if not missing:
+            return
+        n_blocks = -(-self.size // self.block_size)
+        wanted = set(missing)
+        if len(missing) < self.cache_blocks:
+            # Read ahead after the last requested block, as long as everything
+            # still fits into the cache.
+            last = missing[-1]
+            for block in range(last + 1, min(last + 1 + self.read_ahead, n_blocks)):
+                if len(wanted) >= self.cache_blocks:
+                    break
+                if block not in self._blocks:
+                    wanted.add(block)
+        wanted = sorted(wanted)
+        for i in range(0, len(wanted), MAX_VECTOR_READ_CHUNKS):
+            chunks = [
+                (block * self.block_size, self.block_size)
+                for block in wanted[i : i + MAX_VECTOR_READ_CHUNKS]
+            ]
+            # The server rejects chunks beyond the end of the file
+            last_offset, _ = chunks[-1]
+            chunks[-1] = (last_offset, min(self.block_size, self.size - last_offset))
+            status, response = self._file.vector_read(chunks)
+            self._check_status(status, self._error_preamble)
+            for chunk in response.chunks:
+                self._blocks[chunk.offset // self.block_size] = bytes(chunk.buffer)
+                self.bytes_fetched += chunk.length
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._blocks.clear()
+        super().close()
+
+
+@dataclass
+class TransferJob:
+    source: str
+    target: str
+    error_preamble: str
+    done: threading.Event = field(default_factory=threading.Event)
+    error: Optional[Exception] = None
+    # Whether a caller has taken the job into a batch
+    batched: bool = False
+
+
+class TransferBatcher:
+    """
+    Groups concurrently requested transfers into a single XRootD CopyProcess.
+
+    A caller of transfer() whose job is pending while no batch is being
+    collected starts one: it waits up to linger seconds for further jobs and
+    runs its own job together with up to batch_size - 1 pending ones, with
+    `parallel` copy jobs at a time. Callers whose job ended up in another
+    batch wait for its status. Batches run concurrently, and every caller
+    returns once its own batch is done. With a batch_size of 1, or if the
+    caller opts out of batching, a transfer runs in its own copy process right
+    away.
+    """
+
+    def __init__(
+        self,
+        check_status,
+        batch_size: int,
+        parallel: int,
+        linger: float,
+    ):
+        self.check_status = check_status
+        self.batch_size = max(batch_size, 1)
+        self.parallel = max(parallel, 1)
+        self.linger = linger
+        self._pending: List[TransferJob] = []
+        self._collecting = False
+        self._cond = threading.Condition()
+
+    def transfer(
+        self, source: str, target: str, error_preamble: str, batch: bool = True
+    ):
+        """
+        Copy source to target, raising the error of this transfer if any.
+        Unless batch is set, the transfer neither waits for nor joins others.
+        """
+        job = TransferJob(source, target, error_preamble)
+        if self.batch_size == 1 or not batch:
+            self.run([job])
+        else:
+            batch = self._collect(job)
+            if batch:
+                self.run(batch)
+            job.done.wait()
+        if job.error is not None:
+            raise job.error
+
+    def _collect(self, job: TransferJob) -> List[TransferJob]:
+        """
+        Queue job and return the batch to run, or an empty list if another
+        caller took the job into its batch.
+        """
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify_all()
+            while not job.batched:
+                if not self._collecting:
+                    self._collecting = True
+                    self._cond.wait_for(
+                        lambda: len(self._pending) >= self.batch_size, self.linger
+                    )
+                    batch = [job] + [
+                        other for other in self._pending if other is not job
+                    ][: self.batch_size - 1]
+                    for batched in batch:
+                        batched.batched = True
+                    self._pending = [
+                        other for other in self._pending if not other.batched
+                    ]
+                    self._collecting = False
+                    # Let a remaining caller collect the next batch
+                    self._cond.notify_all()
+                    return batch
+                self._cond.wait()
+        return []
+
+    def transfer_many(self, transfers: List[tuple[str, str, str]], batch_size: int):
+        """
+        Copy all (source, target, error_preamble) transfers, batch_size of
+        them per copy process, raising the first error if any.
+        """
+        jobs = [TransferJob(*transfer) for transfer in transfers]
+        batch_size = max(batch_size, 1)
+        for i in range(0, len(jobs), batch_size):
+            self.run(jobs[i : i + batch_size])
+        for job in jobs:
+            if job.error is not None:
+                raise job.error
+
+    def run(self, jobs: List[TransferJob]):
+        """Run the given jobs in one copy process and record their status."""
+        try:
+            process = client.CopyProcess()
+            if len(jobs) > 1:
+                process.parallel(min(self.parallel, len(jobs)))
+            for job in jobs:
+                process.add_job(job.source, job.target, force=True)
+            process.prepare()
+            status, returns = process.run()
+            for i, job in enumerate(jobs):
+                try:
+                    self.check_status(status, job.error_preamble)
+                    if i >= len(returns):
+                        raise WorkflowError(f"{job.error_preamble}: no result")
+                    self.check_status(returns[i]["status"], job.error_preamble)
+                except Exception as e:
+                    job.error = e
+        except Exception as e:
+            for job in jobs:
+                job.error = job.error or e
+        finally:
+            for job in jobs:
+                job.done.set()
+
+
+class StorageProvider(StorageProviderBase):
+    def __post_init__(self):
+        self.username = self.settings.username
+        self.password = self.settings.password
+        if self.password is not None:
+            get_logger().warning(
+                "A password has been specified -- it will be printed "
+                "in plaintext when Snakemake displays the "
+                "inputs/outputs of jobs! Only use this option in "
+                "trusted environments."
+            )
+        self.host = self.settings.host
+        self.port = self.settings.port
+        # List of error codes that there is no point in retrying
+        self.no_retry_codes = [
+            3000,
+            3001,
+            3002,
+            3006,
+            3008,
+            3009,
+            3010,
+            3011,
+            3013,
+            3017,
+            3021,
+            3025,
+            3030,
+            3031,
+            3032,
+        ]
+        self._retry_policy = RetryPolicy(
+            tries=max(self.settings.retry_tries, 1),
+            delay=self.settings.retry_delay,
+            backoff=self.settings.retry_backoff,
+            max_delay=self.settings.retry_max_delay,
+            jitter=self.settings.retry_jitter,
+            deadline=self.settings.retry_deadline,
+            no_retry_codes=frozenset(self.no_retry_codes),
+        )
+        # Error numbers and client status codes signalling an overloaded server
+        self.overload_errnos = [3024, 3034, 3035]
+        self.overload_codes = [103, 206]
+        self.host_max_requests_per_second = self._parse_host_rates(
+            self.settings.host_max_requests_per_second
+        )
+        self.dec_func = None
+        self._dec_code = None
+        if self.settings.url_decorator is not None:
+            self.dec_func = self.load_decorator()
+            if ":" not in self.settings.url_decorator:
+                self._dec_code = compile(
+                    self.settings.url_decorator, "<url_decorator>", "eval"
+                )
+        # Snakemake parses the same queries many times (postprocessing, object
+        # creation), and the result only depends on the query and the settings.
+        self._parse_url = lru_cache(maxsize=PARSED_URL_CACHE_SIZE)(
+            self._parse_url_uncached
+        )
+        self._endpoint_key = lru_cache(maxsize=PARSED_URL_CACHE_SIZE)(
+            self._endpoint_key_uncached
+        )
+        # Parent directories that have already been listed by inventory()
+        self._inventoried_parents = set()
+        # (endpoint, path) of directories known to exist, which need no
+        # further checks before uploading into them
+        self._known_directories = set()
+        # Results of stat_many() per postprocessed query, None if missing
+        self._bulk_stats = {}
+        # Shares concurrent identical stat and dirlist requests
+        self._single_flight = SingleFlight()
+        # Rate limiter per endpoint, see rate_limiter()
+        self._endpoint_rate_limiters = {}
+        self._file_system_pool = FileSystemPool(
+            self.settings.max_connections, self.settings.connection_idle_timeout
+        )
+        self._metadata_cache = None
+        if self.settings.metadata_cache_ttl:
+            self._metadata_cache = MetadataCache(
+                self.settings.metadata_cache_path
+                or str(self.local_prefix / ".xrootd-metadata-cache.sqlite"),
+                self.settings.metadata_cache_ttl,
+            )
+        self._metrics = None
+        if self.settings.metrics or self.settings.metrics_sink:
+            sink = None
+            if self.settings.metrics_sink:
+                sink = self._load_entry_point(self.settings.metrics_sink)
+            self._metrics = XRootDMetrics(sink)
+            # Log the summary when the provider is garbage collected or at exit
+            weakref.finalize(self, self._metrics.log_summary)
+        if self.settings.checksum_type not in CHECKSUM_ALGORITHMS:
+            raise WorkflowError(
+                f"XRootD Error: unsupported checksum_type "
+                f"{self.settings.checksum_type!r}, supported are "
+                f"{', '.join(CHECKSUM_ALGORITHMS)}"
+            )
+        self._local_checksums = LocalChecksumCache()
+        self._node_cache = None
+        if self.settings.node_cache_dir:
+            self._node_cache = NodeCache(
+                self.settings.node_cache_dir, self.settings.node_cache_max_bytes
+            )
+        self._prefetcher = None
+        if self.settings.prefetch_max_bytes:
+            self._prefetcher = Prefetcher(
+                str(self.local_prefix / ".xrootd-prefetch"),
+                self.settings.prefetch_workers,
+                self.settings.prefetch_max_bytes,
+            )
+            weakref.finalize(self, self._prefetcher.shutdown)
+        self._transfer_batcher = TransferBatcher(
+            self._check_status,
+            self.settings.transfer_batch_size,
+            self.settings.transfer_parallel,
+            self.settings.transfer_batch_linger,
+        )
+        # client.File handles of the small-file upload path, one per thread
+        self._small_upload_files = threading.local()
 
     def load_decorator(self):
         if (
@@ -179,22 +2050,177 @@ class StorageProvider(StorageProviderBase):
                 return None
         return None
 
+    @staticmethod
+    def _load_entry_point(entry_point: str):
+        try:
+            module_name, func_name = entry_point.split(":", 1)
+            module = importlib.import_module(module_name)
+            return getattr(module, func_name)
+        except (ValueError, ImportError, AttributeError) as e:
+            raise WorkflowError(
+                f"XRootD Error: failed to load entry point '{entry_point}': {e}"
+            )
+
     def url_decorator(self, url: str) -> str:
         if self.dec_func is not None:
             return self.dec_func(url)
-        if (
-            self.settings.url_decorator is not None
-            and ":" not in self.settings.url_decorator
-        ):
+        if self._dec_code is not None:
             # Fallback for backwards compatibility (eval)
-            return eval(self.settings.url_decorator, {"url": url})
+            return eval(self._dec_code, {"url": url})
         return url
 
+    @staticmethod
+    def _parse_host_rates(spec: Optional[str]) -> dict[str, float]:
+        rates = {}
+        if not spec:
+            return rates
+        for entry in spec.split(","):
+            host, sep, rate = entry.strip().rpartition("=")
+            try:
+                if not sep or not host:
+                    raise ValueError(entry)
+                rates[host] = float(rate)
+            except ValueError:
+                raise WorkflowError(
+                    "XRootD Error: invalid host_max_requests_per_second entry "
+                    f"{entry!r}, expected 'host=rate' or 'host:port=rate'"
+                )
+            if rates[host] <= 0:
+                raise WorkflowError(
+                    "XRootD Error: host_max_requests_per_second must be positive "
+                    f"for {host}"
+                )
+        return rates
+
     def _check_status(self, status: XRootDStatus, error_preamble: str):
         if not status.ok:
             if status.errno in self.no_retry_codes:
-                raise XRootDFatalException(f"{error_preamble}: {status.message}")
-            raise WorkflowError(f"{error_preamble}: {status.message}")
+                error = XRootDFatalException(f"{error_preamble}: {status.message}")
+            elif (
+                status.errno in self.overload_errnos
+                or status.code in self.overload_codes
+            ):
+                error = XRootDOverloadError(f"{error_preamble}: {status.message}")
+                _report_overload()
+            else:
+                error = WorkflowError(f"{error_preamble}: {status.message}")
+            # Lets the metrics count errors by errno
+            error.xrootd_errno = status.errno
+            raise error
+
+    def copy(self, source_query: str, target_query: str):
+        """Copy between two queries of this provider, see StorageObject.copy_to."""
+        source = self.object(self.postprocess_query(source_query), retrieve=False)
+        target = self.object(self.postprocess_query(target_query), retrieve=False)
+        source.copy_to(target)
+
+    def stat_many(self, queries: Iterable[str]) -> dict[str, Optional[StatInfo]]:
+        """
+        Look up many queries at once and return their stat info (None for
+        missing objects).
+
+        Queries are grouped by parent directory. Groups of at least
+        bulk_dirlist_threshold queries are resolved with a single directory
+        listing, smaller groups with concurrent stats. The results are kept,
+        so exists(), mtime() and size() of the corresponding storage objects
+        do not contact the server again.
+        """
+        groups = {}
+        for query in queries:
+            obj = self.object(self.postprocess_query(query), retrieve=False)
+            groups.setdefault(obj.get_inventory_parent(), []).append((query, obj))
+
+        def resolve_group(members):
+            _, first = members[0]
+            if len(members) < max(self.settings.bulk_dirlist_threshold, 1):
+                return [
+                    (query, obj._stat(obj.url.path_with_params, allow_missing=True))
+                    for query, obj in members
+                ]
+            dirlist = first._dirlist(first.dirname + first._params, allow_missing=True)
+            entries = {}
+            if dirlist is not None:
+                entries = {entry.name: entry.statinfo for entry in dirlist.dirlist}
+            return [(query, entries.get(obj.filename)) for query, obj in members]
+
+        # Small groups are split up so that their stats run concurrently
+        tasks = []
+        for members in groups.values():
+            if len(members) < max(self.settings.bulk_dirlist_threshold, 1):
+                tasks.extend([member] for member in members)
+            else:
+                tasks.append(members)
+
+        results = {}
+        with ThreadPoolExecutor(
+            max_workers=max(min(self.settings.glob_workers, len(tasks)), 1)
+        ) as executor:
+            for resolved in executor.map(resolve_group, tasks):
+                for query, stat_info in resolved:
+                    results[query] = stat_info
+        for members in groups.values():
+            for query, obj in members:
+                self._bulk_stats[str(obj.url)] = results[query]
+        return results
+
+    def prefetch(self, queries: Iterable[str]) -> int:
+        """
+        Start downloading the given queries into the local storage prefix in
+        the background, so that retrieving them later only waits for the
+        transfer that is already in progress. Missing objects and directories
+        are skipped, as are files that do not fit into prefetch_max_bytes.
+
+        Returns the number of queries being prefetched. Does nothing unless
+        prefetch_max_bytes is set.
+        """
+        if self._prefetcher is None:
+            return 0
+        scheduled = 0
+        for query, stat_info in self.stat_many(queries).items():
+            if stat_info is None or stat_info.flags & StatInfoFlags.IS_DIR:
+                continue
+            obj = self.object(self.postprocess_query(query), retrieve=False)
+            if obj._prefetch(stat_info):
+                scheduled += 1
+        return scheduled
+
+    def cancel_prefetch(self, queries: Optional[Iterable[str]] = None):
+        """Cancel prefetching the given queries (by default all of them)."""
+        if self._prefetcher is None:
+            return
+        if queries is None:
+            self._prefetcher.cancel()
+            return
+        for query in queries:
+            obj = self.object(self.postprocess_query(query), retrieve=False)
+            self._prefetcher.cancel(str(obj.url))
+
+    @staticmethod
+    def _directory_key(endpoint: str, path: str) -> tuple[str, str]:
+        path = path.split("?", 1)[0]
+        return endpoint, "/" + "/".join(part for part in path.split("/") if part)
+
+    def _add_known_directory(self, endpoint: str, path: str):
+        self._known_directories.add(self._directory_key(endpoint, path))
+
+    def _is_known_directory(self, endpoint: str, path: str) -> bool:
+        return self._directory_key(endpoint, path) in self._known_directories
+
+    def _forget_known_directories(self, endpoint: str, path: str):
+        """Forget the directory at path and all directories below it."""
+        endpoint, path = self._directory_key(endpoint, path)
+        prefix = path.rstrip("/") + "/"
+        for known in list(self._known_directories):
+            if known[0] == endpoint and (
+                known[1] == path or known[1].startswith(prefix)
+            ):
+                self._known_directories.discard(known)
+
+    def _measure(self, operation: str, query: str):
+        """Measure an operation on the endpoint of query, if metrics are enabled."""
+        if self._metrics is None:
+            return _NO_MEASUREMENT
+        return self._metrics.measure(operation, self._endpoint_key(query))
 
     @classmethod
     def example_queries(cls) -> List[ExampleQuery]:
@@ -214,7 +2240,6 @@ class StorageProvider(StorageProviderBase):
             ),
         ]
 
-    # ?
     def rate_limiter_key(self, query: str, operation: Operation) -> Any:
         """Return a key for identifying a rate limiter given a query and an operation.
 
@@ -222,7 +2247,39 @@ class StorageProvider(StorageProviderBase):
         E.g. for a storage provider like http that would be the host name.
         For s3 it might be just the endpoint URL.
         """
-        return "xrootd"
+        return self._endpoint_key(query)
+
+    def _endpoint_key_uncached(self, query: str) -> str:
+        # Queries reaching the storage objects have already been through
+        # postprocess_query, so host and port are always filled in.
+        url = URL(query)
+        return f"{url.hostname}:{url.port}"
+
+    def rate_limiter(self, query: str, operation: Operation):
+        if not self.use_rate_limiter():
+            return nullcontext()
+        key = self.rate_limiter_key(query, operation)
+        limiters = self._endpoint_rate_limiters
+        if key not in limiters:
+            rate = self._max_requests_per_second(key)
+            if self.settings.adaptive_rate_limit:
+                limiters[key] = AdaptiveThrottler(rate)
+            else:
+                rate_frac = Fraction(rate).limit_denominator()
+                limiters[key] = Throttler(
+                    rate_limit=rate_frac.numerator, period=rate_frac.denominator
+                )
+        return limiters[key]
+
+    def _max_requests_per_second(self, host_port: str) -> float:
+        host = host_port.rsplit(":", 1)[0]
+        for key in (host_port, host):
+            if key in self.host_max_requests_per_second:
+                return self.host_max_requests_per_second[key]
+        return (
+            self.settings.max_requests_per_second
+            or self.default_max_requests_per_second()
+        )
 
     def default_max_requests_per_second(self) -> float:
         """Return the default maximum number of requests per second for this storage
@@ -256,7 +2313,12 @@ class StorageProvider(StorageProviderBase):
         sep = "&" if "?" in url else "?"
         return f"{url}{sep}{key}={quote(value, safe=',')}"
 
-    def _parse_url(self, query: str) -> List[str] | None:
+    def _parse_url_uncached(self, query: str) -> List[str] | None:
+        """
+        Apply the global settings and the url_decorator to a query.
+
+        Use the memoized _parse_url set up in __post_init__ instead.
+        """
         url = URL(query)
         user = self.username or url.username
         password = self.password or url.password
@@ -353,13 +2415,46 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
         # Does is_valid_query happen before this or we need to verify here too?
         self.url, self.dirname, self.filename = self.provider._parse_url(self.query)
         self.path = self.url.path
-        self.file_system = client.FileSystem(str(self.url))
+        self._url_prefix, self._params = self._split_url(str(self.url))
+        # Progress of interrupted transfers per direction, see _progress()
+        self._transfer_progress = {}
+        # Handles are owned by the provider's pool, we only remember the endpoint
+        self._endpoint = self._url_prefix + "/" + self._params
+
+    @property
+    def file_system(self) -> client.FileSystem:
+        return self.provider._file_system_pool.get(self._endpoint)
 
     @xrootd_retry
     def _stat(
         self, path_with_params: str, allow_missing: bool = False
     ) -> Optional[StatInfo]:
-        status, stat_info = self.file_system.stat(path_with_params)
+        with self.provider._measure("stat", self.query):
+            status, stat_info = self.provider._single_flight.do(
+                ("stat", self._single_flight_key(path_with_params)),
+                lambda: self.file_system.stat(path_with_params),
+            )
+            return self._stat_result(path_with_params, allow_missing, status, stat_info)
+
+    @xrootd_retry_async
+    async def _stat_async(
+        self, path_with_params: str, allow_missing: bool = False
+    ) -> Optional[StatInfo]:
+        with self.provider._measure("stat", self.query):
+            status, stat_info = await self.provider._single_flight.do_async(
+                ("stat", self._single_flight_key(path_with_params)),
+                lambda: _xrootd_call(self.file_system.stat, path_with_params),
+            )
+            return self._stat_result(path_with_params, allow_missing, status, stat_info)
+
+    def _stat_result(
+        self,
+        path_with_params: str,
+        allow_missing: bool,
+        status: XRootDStatus,
+        stat_info: Optional[StatInfo],
+    ) -> Optional[StatInfo]:
+        """Check the response to a stat request of _stat() or _stat_async()."""
         # 3011==file not found is in the no_retry_codes list, so we need to handle it here
         if allow_missing and not status.ok and status.errno == 3011:
             return None
@@ -367,29 +2462,144 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
             status,
             f"Error checking info of {self.provider._safe_to_print_url(self.query)}",
         )
+        if stat_info.flags & StatInfoFlags.IS_DIR:
+            self.provider._add_known_directory(self._endpoint, path_with_params)
+        return stat_info
+
+    def _single_flight_key(self, path_with_params: str) -> str:
+        # Requests with different credentials or parameters (e.g. authz
+        # tokens) must not be shared, but the key should not hold them.
+        url = self._url_prefix + path_with_params
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _metadata_key(self, path_with_params: str) -> str:
+        # Credentials and parameters do not change the metadata of a file and
+        # must not end up on disk.
+        path = "/".join(
+            part for part in path_with_params.split("?")[0].split("/") if part
+        )
+        return f"{self.url.protocol}://{self.url.hostname}:{self.url.port}/{path}"
+
+    def _cached_stat(
+        self, path_with_params: str, allow_missing: bool = False
+    ) -> Optional[StatInfo]:
+        found, stat_info = self._lookup_cached_stat(path_with_params, allow_missing)
+        if not found:
+            stat_info = self._stat(path_with_params, allow_missing=allow_missing)
+            self._store_cached_stat(path_with_params, stat_info)
+        return stat_info
+
+    async def _cached_stat_async(
+        self, path_with_params: str, allow_missing: bool = False
+    ) -> Optional[StatInfo]:
+        found, stat_info = self._lookup_cached_stat(path_with_params, allow_missing)
+        if not found:
+            stat_info = await self._stat_async(
+                path_with_params, allow_missing=allow_missing
+            )
+            self._store_cached_stat(path_with_params, stat_info)
         return stat_info
 
+    def _lookup_cached_stat(
+        self, path_with_params: str, allow_missing: bool
+    ) -> tuple[bool, Optional[StatInfo]]:
+        """Return whether stat_many() or the metadata cache know the object."""
+        found, stat_info = self._bulk_stat(path_with_params)
+        # Missing objects are checked again to raise the usual error
+        if found and (stat_info is not None or allow_missing):
+            return True, stat_info
+        cache = self.provider._metadata_cache
+        if cache is not None:
+            stat_info = cache.get_stat(self._metadata_key(path_with_params))
+            if stat_info is not None:
+                return True, stat_info
+        return False, None
+
+    def _store_cached_stat(self, path_with_params: str, stat_info: Optional[StatInfo]):
+        cache = self.provider._metadata_cache
+        if cache is not None and stat_info is not None:
+            cache.put_stat(self._metadata_key(path_with_params), stat_info)
+
+    def _bulk_stat(self, path_with_params: str) -> tuple[bool, Optional[StatInfo]]:
+        """Return whether stat_many() looked up this object, and its result."""
+        if path_with_params != self.url.path_with_params:
+            return False, None
+        key = str(self.url)
+        bulk_stats = self.provider._bulk_stats
+        if key not in bulk_stats:
+            return False, None
+        return True, bulk_stats[key]
+
+    def _invalidate_metadata(self, recursive: bool = False):
+        """
+        Forget the metadata of this object, and with recursive, also of
+        everything below it (for directories).
+        """
+        bulk_stats = self.provider._bulk_stats
+        bulk_stats.pop(str(self.url), None)
+        if recursive:
+            prefix = self._url_prefix + self.path.rstrip("/") + "/"
+            for url in [url for url in bulk_stats if url.startswith(prefix)]:
+                del bulk_stats[url]
+        if self.provider._metadata_cache is not None:
+            self.provider._metadata_cache.invalidate(
+                self._metadata_key(self.url.path_with_params), recursive=recursive
+            )
+
     def _exists(self, path_with_params: str) -> bool:
         return self._stat(path_with_params, allow_missing=True) is not None
 
-    @xrootd_retry
-    def _makedirs(self):
-        if not self._exists(URL(self.get_inventory_parent()).path_with_params):
-            status, _ = self.file_system.mkdir(self.dirname, MkDirFlags.MAKEPATH)
-            self.provider._check_status(
-                status,
-                "Error creating directory "
-                f"{self.provider._safe_to_print_url(self.query)}",
+    def _add_listed_directories(self, path_with_params: str, dirlist: DirectoryList):
+        self.provider._add_known_directory(self._endpoint, path_with_params)
+        parent = path_with_params.split("?", 1)[0].rstrip("/") + "/"
+        for entry in dirlist.dirlist:
+            if (
+                entry.statinfo is not None
+                and entry.statinfo.flags & StatInfoFlags.IS_DIR
+            ):
+                self.provider._add_known_directory(self._endpoint, parent + entry.name)
+
+    def _add_created_directory(self, path: str):
+        # mkdir with MAKEPATH also created all parents
+        parts = [part for part in path.split("?", 1)[0].split("/") if part]
+        for i in range(len(parts) + 1):
+            self.provider._add_known_directory(
+                self._endpoint, "/" + "/".join(parts[:i])
             )
 
+    @xrootd_retry
+    def _makedirs(self, dirname: Optional[str] = None):
+        """Create dirname (by default the parent of this object) with its parents."""
+        dirname = dirname or self.dirname
+        if self.provider._is_known_directory(self._endpoint, dirname):
+            return
+        optimistic = self.provider.settings.optimistic_mkdir
+        if optimistic or not self._exists(dirname + self._params):
+            with self.provider._measure("mkdir", self.query):
+                status, _ = self.file_system.mkdir(dirname, MkDirFlags.MAKEPATH)
+                # 3018==already exists is the expected outcome for optimistic mkdirs
+                if not (optimistic and not status.ok and status.errno == 3018):
+                    self.provider._check_status(
+                        status,
+                        "Error creating directory "
+                        f"{self.provider._safe_to_print_url(self.query)}",
+                    )
+        self._add_created_directory(dirname)
+
     @staticmethod
-    def _url_with_new_path(url: str, new_path: str) -> str:
+    def _split_url(url: str) -> tuple[str, str]:
+        """
+        Split a URL into the part before its path (protocol and host id with a
+        trailing "/") and its parameters (including the "?", if any).
+        """
         parsed = URL(url)
-        parsed_params = parsed.path_with_params[len(parsed.path) :]
+        params = parsed.path_with_params[len(parsed.path) :]
+        return f"{parsed.protocol}://{parsed.hostid}/", params
 
-        new_url = (
-            parsed.protocol + "://" + parsed.hostid + "/" + new_path + parsed_params
-        )
+    @staticmethod
+    def _url_with_new_path(url: str, new_path: str) -> str:
+        prefix, params = StorageObject._split_url(url)
+        new_url = prefix + new_path + params
         if not URL(new_url).is_valid():
             raise WorkflowError(
                 f"XRootD Error: URL {StorageProvider._safe_to_print_url(new_url)} is invalid"
@@ -397,37 +2607,143 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
         return new_url
 
     @xrootd_retry
-    def _dirlist(self, path_with_params: str) -> DirectoryList:
-        status, dirlist = self.file_system.dirlist(path_with_params, DirListFlags.STAT)
+    def _dirlist(
+        self, path_with_params: str, allow_missing: bool = False
+    ) -> Optional[DirectoryList]:
+        with self.provider._measure("dirlist", self.query):
+            status, dirlist = self.provider._single_flight.do(
+                ("dirlist", self._single_flight_key(path_with_params)),
+                lambda: self.file_system.dirlist(path_with_params, DirListFlags.STAT),
+            )
+            return self._dirlist_result(
+                path_with_params, allow_missing, status, dirlist
+            )
+
+    def _cached_dirlist(self, path_with_params: str) -> DirectoryList:
+        cache = self.provider._metadata_cache
+        if cache is None:
+            return self._dirlist(path_with_params)
+        key = self._metadata_key(path_with_params)
+        dirlist = cache.get_dirlist(key)
+        if dirlist is None:
+            dirlist = self._dirlist(path_with_params)
+            cache.put_dirlist(key, dirlist)
+        return dirlist
+
+    @xrootd_retry_async
+    async def _dirlist_async(
+        self, path_with_params: str, allow_missing: bool = False
+    ) -> Optional[DirectoryList]:
+        with self.provider._measure("dirlist", self.query):
+            status, dirlist = await self.provider._single_flight.do_async(
+                ("dirlist", self._single_flight_key(path_with_params)),
+                lambda: _xrootd_call(
+                    self.file_system.dirlist, path_with_params, DirListFlags.STAT
+                ),
+            )
+            return self._dirlist_result(
+                path_with_params, allow_missing, status, dirlist
+            )
+
+    def _dirlist_result(
+        self,
+        path_with_params: str,
+        allow_missing: bool,
+        status: XRootDStatus,
+        dirlist: Optional[DirectoryList],
+    ) -> Optional[DirectoryList]:
+        """Check the response to a dirlist request of _dirlist() or _dirlist_async()."""
+        # 3011==file not found is in the no_retry_codes list, so we need to handle it here
+        if allow_missing and not status.ok and status.errno == 3011:
+            return None
         self.provider._check_status(
             status,
             f"Error listing directory {self.provider._safe_to_print_url(self.query)}",
         )
+        self._add_listed_directories(path_with_params, dirlist)
         return dirlist
 
-    # TODO
+    @staticmethod
+    def _is_suspicious_entry_name(name: str) -> bool:
+        # Dirlist should never return entries with empty names or "." or ".." or
+        # names containing slashes, but we check for that anyway to be safe.
+        return not name or name in (".", "..") or "/" in name or "\\" in name
+
     async def inventory(self, cache: IOCacheStorageInterface):
         """From this file, try to find as much existence and modification date
         information as possible. Only retrieve that information that comes for free
         given the current object.
         """
-        # This is optional and can be left as is
-
-        # If this is implemented in a storage object, results have to be stored in
-        # the given IOCache object, using self.cache_key() as key.
-        # Optionally, this can take a custom local suffix, needed e.g. when you want
-        # to cache more items than the current query: self.cache_key(local_suffix=...)
-        pass
+        # A single listing of the parent directory gives us existence, mtime and
+        # size of this object and all of its siblings.
+        parent = self.get_inventory_parent()
+        if parent in self.provider._inventoried_parents:
+            return
+        self.provider._inventoried_parents.add(parent)
+
+        try:
+            dirlist = await self._dirlist_async(
+                URL(parent).path_with_params, allow_missing=True
+            )
+        except Exception as e:
+            # The inventory is only an optimization. Servers may allow reading
+            # files in directories that cannot be listed, so leave this object
+            # to exists(), mtime() and size().
+            self.provider._inventoried_parents.discard(parent)
+            get_logger().debug(
+                "Could not list "
+                f"{self.provider._safe_to_print_url(parent)} for the inventory: {e}"
+            )
+            return
+        if dirlist is not None:
+            # The path of this object without the filename, as used by local_suffix()
+            path_prefix = self.path[: len(self.path) - len(self.filename)]
+            for entry in dirlist.dirlist:
+                if self._is_suspicious_entry_name(entry.name):
+                    continue
+                key = self.cache_key(
+                    self._local_suffix_from_path(path_prefix + entry.name)
+                )
+                cache.exists_in_storage[key] = True
+                if (
+                    entry.name == self.filename
+                    and entry.statinfo is not None
+                    and not entry.statinfo.flags & StatInfoFlags.IS_DIR
+                    and self.provider._prefetcher is not None
+                    and self.provider.settings.prefetch_on_inventory
+                ):
+                    self._prefetch(entry.statinfo)
+                # mtime and size of directories are aggregated over their tree
+                # by mtime() and size()
+                if (
+                    entry.statinfo is not None
+                    and not entry.statinfo.flags & StatInfoFlags.IS_DIR
+                ):
+                    cache.mtime[key] = Mtime(storage=entry.statinfo.modtime)
+                    cache.size[key] = entry.statinfo.size
+
+        key = self.cache_key()
+        if key not in cache.exists_in_storage:
+            cache.exists_in_storage[key] = False
+        # Tell the cache that everything below this parent is known, so that
+        # objects not found in the listing are considered missing.
+        has_inventory = getattr(cache.exists_in_storage, "has_inventory", None)
+        if has_inventory is not None:
+            has_inventory.add(parent)
 
     def get_inventory_parent(self) -> Optional[str]:
         """Return the parent directory of this object."""
         # this is optional and can be left as is
-        return self._url_with_new_path(str(self.url), self.dirname)
+        return self._url_prefix + self.dirname + self._params
 
     def local_suffix(self) -> str:
         """Return a unique suffix for the local path, determined from self.query."""
+        return self._local_suffix_from_path(str(self.path))
+
+    @staticmethod
+    def _local_suffix_from_path(path: str) -> str:
         # path always has a '/' at the end which we do not want here
-        return str(self.path)[2:]
+        return path[2:]
 
     # Check but should be nothing?
     def cleanup(self):
@@ -437,40 +2753,587 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
         pass
 
     def exists(self) -> bool:
-        return self._exists(self.url.path_with_params)
+        return (
+            self._cached_stat(self.url.path_with_params, allow_missing=True) is not None
+        )
 
     def mtime(self) -> float:
         # return the modification time
-        stat = self._stat(self.url.path_with_params)
+        stat = self._cached_stat(self.url.path_with_params)
+        if stat.flags & StatInfoFlags.IS_DIR:
+            return self._tree_mtime(stat)
         return stat.modtime
 
     def size(self) -> int:
         # return the size in bytes
-        stat = self._stat(self.url.path_with_params)
+        stat = self._cached_stat(self.url.path_with_params)
+        if stat.flags & StatInfoFlags.IS_DIR:
+            return self._tree_size()
         return stat.size
 
+    def _tree_mtime(self, stat: StatInfo) -> float:
+        """Latest modification time of a directory and everything below it."""
+        files, dirs = self._list_tree(cached=True)
+        return max(
+            [stat.modtime]
+            + [info.modtime for info in files.values()]
+            + [info.modtime for info in dirs.values()]
+        )
+
+    def _tree_size(self) -> int:
+        """Total size of the files below a directory."""
+        files, _ = self._list_tree(cached=True)
+        return sum(info.size for info in files.values())
+
+    # The managed_* methods are called by Snakemake from its event loop, use the
+    # asynchronous client there so that many requests can be in flight at once.
+
+    async def managed_exists(self) -> bool:
+        try:
+            async with self._rate_limiter(Operation.EXISTS):
+                stat = await self._cached_stat_async(
+                    self.url.path_with_params, allow_missing=True
+                )
+                return stat is not None
+        except Exception as e:
+            raise WorkflowError(f"Failed to check existence of {self.print_query}", e)
+
+    async def managed_mtime(self) -> float:
+        try:
+            async with self._rate_limiter(Operation.MTIME):
+                stat = await self._cached_stat_async(self.url.path_with_params)
+                if stat.flags & StatInfoFlags.IS_DIR:
+                    return await asyncio.to_thread(self._tree_mtime, stat)
+                return stat.modtime
+        except Exception as e:
+            self._raise_object_not_found_if_not_exists()
+            raise WorkflowError(f"Failed to get mtime of {self.print_query}", e)
+
+    async def managed_size(self) -> int:
+        try:
+            async with self._rate_limiter(Operation.SIZE):
+                stat = await self._cached_stat_async(self.url.path_with_params)
+                if stat.flags & StatInfoFlags.IS_DIR:
+                    return await asyncio.to_thread(self._tree_size)
+                return stat.size
+        except Exception as e:
+            self._raise_object_not_found_if_not_exists()
+            raise WorkflowError(f"Failed to get size of {self.print_query}", e)
+
     @xrootd_retry
     def retrieve_object(self):
         # Ensure that the object is accessible locally under self.local_path()
         # check if dir
 
-        process = client.CopyProcess()
-
         # local path must be an absoulte path as well
         local_path = os.path.abspath(self.local_path())
-        process.add_job(str(self.url), local_path, force=True)
+        stat_info = self._retrieval_stat()
+        if self._is_unchanged(local_path, stat_info):
+            return
+        with self.provider._measure("retrieve", self.query) as measurement:
+            if stat_info is None:
+                # Nothing needs the stat info, copy right away and only check
+                # for a directory if that fails.
+                try:
+                    self._download(local_path, None)
+                except Exception:
+                    stat_info = self._stat(
+                        self.url.path_with_params, allow_missing=True
+                    )
+                    if stat_info is None or not stat_info.flags & StatInfoFlags.IS_DIR:
+                        raise
+                else:
+                    if measurement is not None:
+                        measurement.nbytes = os.path.getsize(local_path)
+                    return
+            if stat_info.flags & StatInfoFlags.IS_DIR:
+                nbytes = self._download_directory(local_path)
+                if measurement is not None:
+                    measurement.nbytes = nbytes
+                return
+            prefetched = None
+            if self.provider._prefetcher is not None:
+                prefetched = self.provider._prefetcher.take(str(self.url), stat_info)
+            if prefetched is not None:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                os.replace(prefetched, local_path)
+                downloaded = True
+            else:
+                downloaded = self._fetch(local_path, stat_info)
+            if measurement is not None and downloaded:
+                measurement.nbytes = os.path.getsize(local_path)
 
-        process.prepare()
-        status, returns = process.run()
-        self.provider._check_status(
-            status,
-            f"Error downloading from {self.provider._safe_to_print_url(self.query)}",
+    def _retrieval_stat(self) -> Optional[StatInfo]:
+        """
+        Stat info for retrieving this object, from stat_many() or the metadata
+        cache if possible. None if it is not known yet and nothing requires it.
+        """
+        prefetcher = self.provider._prefetcher
+        if prefetcher is not None and str(self.url) in prefetcher:
+            # Prefetched files are checked against the current remote file.
+            return self._stat(self.url.path_with_params)
+        found, stat_info = self._lookup_cached_stat(self.url.path_with_params, False)
+        if found:
+            return stat_info
+        settings = self.provider.settings
+        if (
+            settings.skip_unchanged_transfers
+            or settings.resumable_transfers
+            or settings.parallel_download_threshold is not None
+            or self.provider._node_cache is not None
+        ):
+            return self._cached_stat(self.url.path_with_params)
+        return None
+
+    def _fetch(self, local_path: str, stat_info: StatInfo, batch: bool = True) -> bool:
+        """
+        Download the file to local_path, through the node cache if enabled.
+        Returns whether it was downloaded rather than found in the node cache.
+        """
+        node_cache = self.provider._node_cache
+        if node_cache is None:
+            self._download(local_path, stat_info, batch)
+            return True
+        key = (
+            f"{self._metadata_key(self.url.path_with_params)}"
+            f":{stat_info.size}:{stat_info.modtime}"
         )
-        self.provider._check_status(
-            returns[0]["status"],
-            f"Error downloading from {self.provider._safe_to_print_url(self.query)}",
+        return node_cache.retrieve(
+            key, local_path, lambda path: self._download(path, stat_info, batch)
         )
 
+    def _prefetch(self, stat_info: StatInfo) -> bool:
+        # Prefetches run on their own workers and copy processes, so that
+        # retrievals never queue behind them in the transfer batcher.
+        return self.provider._prefetcher.schedule(
+            str(self.url),
+            stat_info,
+            lambda path: self._fetch(path, stat_info, batch=False),
+        )
+
+    def _download(
+        self, local_path: str, stat_info: Optional[StatInfo], batch: bool = True
+    ):
+        threshold = self.provider.settings.parallel_download_threshold
+        if threshold is not None and stat_info.size >= threshold:
+            self._download_chunked(local_path, stat_info)
+        elif self.provider.settings.resumable_transfers:
+            self._download_resumable(local_path, stat_info)
+        else:
+            self.provider._transfer_batcher.transfer(
+                str(self.url),
+                local_path,
+                f"Error downloading from {self.provider._safe_to_print_url(self.query)}",
+                batch=batch,
+            )
+
+    def _list_tree(
+        self, cached: bool = False
+    ) -> tuple[dict[str, StatInfo], dict[str, StatInfo]]:
+        """
+        List the directory tree below this object, returning the stat info of
+        all files and of all subdirectories by their path relative to it.
+
+        The directories of each level of the tree are listed concurrently.
+        """
+        list_func = self._cached_dirlist if cached else self._dirlist
+        root = self.path.rstrip("/")
+        files, dirs = {}, {}
+
+        def list_dir(rel_path: str):
+            return rel_path, list_func(root + "/" + rel_path + self._params)
+
+        level = [""]
+        depth = 0
+        while level:
+            if depth > self.provider.settings.glob_wildcards_max_depth:
+                raise WorkflowError(
+                    "XRootD Error: directory nesting exceeds maximum depth of "
+                    f"{self.provider.settings.glob_wildcards_max_depth} below "
+                    f"{self.provider._safe_to_print_url(self.query)}"
+                )
+            next_level = []
+            for rel_path, dirlist in _map_concurrently(
+                list_dir, level, self.provider.settings.glob_workers
+            ):
+                prefix = rel_path + "/" if rel_path else ""
+                for entry in dirlist.dirlist:
+                    if self._is_suspicious_entry_name(entry.name):
+                        continue
+                    if entry.statinfo.flags & StatInfoFlags.IS_DIR:
+                        dirs[prefix + entry.name] = entry.statinfo
+                        next_level.append(prefix + entry.name)
+                    else:
+                        files[prefix + entry.name] = entry.statinfo
+            level = next_level
+            depth += 1
+        return files, dirs
+
+    def _download_directory(self, local_path: str) -> int:
+        """Download the tree below this directory, returning its size in bytes."""
+        files, dirs = self._list_tree()
+        root = self._url_prefix + self.path.rstrip("/") + "/"
+        os.makedirs(local_path, exist_ok=True)
+        for rel_path in dirs:
+            os.makedirs(os.path.join(local_path, rel_path), exist_ok=True)
+        self.provider._transfer_batcher.transfer_many(
+            [
+                (
+                    root + rel_path + self._params,
+                    os.path.join(local_path, rel_path),
+                    "Error downloading from "
+                    + self.provider._safe_to_print_url(root + rel_path + self._params),
+                )
+                for rel_path in files
+            ],
+            self.provider.settings.directory_transfer_batch_size,
+        )
+        return sum(info.size for info in files.values())
+
+    def _upload_directory(self, local_path: str) -> int:
+        """Upload the tree below a local directory, returning its size in bytes."""
+        root = self.path.rstrip("/")
+        files = []
+        leaf_dirs = []
+        for dirpath, dirnames, filenames in os.walk(local_path):
+            rel_dir = os.path.relpath(dirpath, local_path)
+            remote_dir = root if rel_dir == "." else root + "/" + rel_dir
+            # mkdir creates all parents, so only the leaves of the tree are needed
+            if not dirnames:
+                leaf_dirs.append(remote_dir)
+            for filename in filenames:
+                files.append(
+                    (os.path.join(dirpath, filename), remote_dir + "/" + filename)
+                )
+        _map_concurrently(
+            self._makedirs, leaf_dirs, self.provider.settings.glob_workers
+        )
+        self.provider._transfer_batcher.transfer_many(
+            [
+                (
+                    source,
+                    self._url_prefix + target + self._params,
+                    "Error uploading to "
+                    + self.provider._safe_to_print_url(
+                        self._url_prefix + target + self._params
+                    ),
+                )
+                for source, target in files
+            ],
+            self.provider.settings.directory_transfer_batch_size,
+        )
+        return sum(os.path.getsize(source) for source, _ in files)
+
+    def _progress(self, direction: str) -> TransferProgress:
+        """
+        Progress of transfers of this object in the given direction ("download"
+        or "upload"), persisted in the local prefix if resumable_transfers is set.
+        """
+        progress = self._transfer_progress.get(direction)
+        if progress is None:
+            path = None
+            if self.provider.settings.resumable_transfers:
+                name = hashlib.sha256(
+                    f"{direction}:{self.url.path}:{self.local_path()}".encode()
+                ).hexdigest()
+                path = str(
+                    self.provider.local_prefix / ".xrootd-progress" / f"{name}.json"
+                )
+            progress = self._transfer_progress[direction] = TransferProgress(path)
+        return progress
+
+    def _download_chunked(self, local_path: str, stat_info: StatInfo):
+        """
+        Download the file in chunks over several streams into a preallocated
+        local file and verify its checksum.
+
+        Chunks that were written completely are recorded, so when some chunks
+        fail, a retry of retrieve_object only fetches the missing ones.
+        """
+        settings = self.provider.settings
+        chunk_size = max(settings.parallel_download_chunk_size, 1)
+        error_preamble = (
+            f"Error downloading from {self.provider._safe_to_print_url(self.query)}"
+        )
+        target = local_path
+        if settings.resumable_transfers:
+            target += PARTIAL_SUFFIX
+        progress = self._progress("download")
+        state = progress.load(
+            {
+                "size": stat_info.size,
+                "modtime": stat_info.modtime,
+                "chunk_size": chunk_size,
+            }
+        )
+        if not os.path.exists(target):
+            state.clear()
+        done = state.setdefault("chunks", [])
+        offsets = sorted(
+            set(range(0, stat_info.size, chunk_size)) - set(done), reverse=True
+        )
+        piece_size = min(chunk_size, TRANSFER_PIECE_SIZE)
+
+        fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not done:
+                os.ftruncate(fd, stat_info.size)
+            lock = threading.Lock()
+            errors = []
+
+            def stream():
+                file = client.File()
+                status, _ = file.open(str(self.url), OpenFlags.READ)
+                self.provider._check_status(status, error_preamble)
+                try:
+                    while True:
+                        with lock:
+                            if not offsets or errors:
+                                return
+                            offset = offsets.pop()
+                        try:
+                            end = min(offset + chunk_size, stat_info.size)
+                            for start in range(offset, end, piece_size):
+                                status, data = file.read(
+                                    start, min(piece_size, end - start)
+                                )
+                                self.provider._check_status(status, error_preamble)
+                                os.pwrite(fd, data, start)
+                        except Exception as e:
+                            with lock:
+                                errors.append(e)
+                            return
+                        with lock:
+                            done.append(offset)
+                            if progress.path is not None:
+                                os.fsync(fd)
+                                progress.save()
+                finally:
+                    file.close()
+
+            n_streams = max(min(settings.parallel_download_streams, len(offsets)), 1)
+            with ThreadPoolExecutor(max_workers=n_streams) as executor:
+                futures = [executor.submit(stream) for _ in range(n_streams)]
+            for future in futures:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+            if errors:
+                raise errors[0]
+        finally:
+            os.close(fd)
+
+        self._finish_download(target, local_path, progress, error_preamble)
+
+    def _download_resumable(self, local_path: str, stat_info: StatInfo):
+        """
+        Download the file to a temporary name, continuing after the last
+        offset recorded by a previous attempt.
+        """
+        error_preamble = (
+            f"Error downloading from {self.provider._safe_to_print_url(self.query)}"
+        )
+        target = local_path + PARTIAL_SUFFIX
+        progress = self._progress("download")
+        state = progress.load({"size": stat_info.size, "modtime": stat_info.modtime})
+        offset = state.get("offset", 0)
+        if not os.path.exists(target) or os.path.getsize(target) < offset:
+            offset = 0
+
+        file = client.File()
+        status, _ = file.open(str(self.url), OpenFlags.READ)
+        self.provider._check_status(status, error_preamble)
+        fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, offset)
+            while offset < stat_info.size:
+                status, data = file.read(
+                    offset, min(TRANSFER_PIECE_SIZE, stat_info.size - offset)
+                )
+                self.provider._check_status(status, error_preamble)
+                if not data:
+                    break
+                os.pwrite(fd, data, offset)
+                os.fsync(fd)
+                offset += len(data)
+                state["offset"] = offset
+                progress.save()
+        finally:
+            os.close(fd)
+            file.close()
+
+        self._finish_download(target, local_path, progress, error_preamble)
+
+    def _finish_download(
+        self,
+        target: str,
+        local_path: str,
+        progress: TransferProgress,
+        error_preamble: str,
+    ):
+        progress.clear()
+        if self._checksums_match(target) is False:
+            os.remove(target)
+            raise WorkflowError(
+                f"{error_preamble}: checksum of the downloaded file does not match"
+            )
+        if target != local_path:
+            os.replace(target, local_path)
+
+    def _upload_resumable(self, local_path: str):
+        """
+        Upload the file to a temporary name next to the target, continuing
+        after the last offset recorded by a previous attempt, and rename it
+        when complete.
+        """
+        error_preamble = (
+            f"Error uploading to {self.provider._safe_to_print_url(self.query)}"
+        )
+        partial_path = self.url.path + PARTIAL_SUFFIX
+        partial_url = self._url_prefix + partial_path + self._params
+        st = os.stat(local_path)
+        progress = self._progress("upload")
+        state = progress.load({"size": st.st_size, "mtime": st.st_mtime_ns})
+        offset = state.get("offset", 0)
+        if offset:
+            remote = self._stat(partial_path + self._params, allow_missing=True)
+            if remote is None or remote.size < offset:
+                offset = 0
+
+        file = client.File()
+        flags = OpenFlags.UPDATE if offset else OpenFlags.DELETE | OpenFlags.MAKEPATH
+        status, _ = file.open(partial_url, flags)
+        self.provider._check_status(status, error_preamble)
+        try:
+            with open(local_path, "rb") as f:
+                f.seek(offset)
+                for data in iter(lambda: f.read(TRANSFER_PIECE_SIZE), b""):
+                    status, _ = file.write(data, offset)
+                    self.provider._check_status(status, error_preamble)
+                    status, _ = file.sync()
+                    self.provider._check_status(status, error_preamble)
+                    offset += len(data)
+                    state["offset"] = offset
+                    progress.save()
+            status, _ = file.truncate(offset)
+            self.provider._check_status(status, error_preamble)
+        finally:
+            file.close()
+
+        progress.clear()
+        if self._checksums_match(local_path, partial_path + self._params) is False:
+            self._rm(partial_path + self._params)
+            raise WorkflowError(
+                f"{error_preamble}: checksum of the uploaded file does not match"
+            )
+        # mv does not replace existing files on all servers
+        if self._exists(self.url.path_with_params):
+            self._rm(self.url.path_with_params)
+        status, _ = self.file_system.mv(
+            partial_path + self._params, self.url.path_with_params
+        )
+        self.provider._check_status(status, error_preamble)
+
+    def _rm(self, path_with_params: str, is_dir: bool = False):
+        rm_func = self.file_system.rmdir if is_dir else self.file_system.rm
+        if is_dir:
+            self.provider._forget_known_directories(self._endpoint, path_with_params)
+        if self.provider._metadata_cache is not None:
+            self.provider._metadata_cache.invalidate(
+                self._metadata_key(path_with_params)
+            )
+        with self.provider._measure("remove", self.query):
+            status, _ = rm_func(path_with_params)
+            self.provider._check_status(
+                status,
+                "Error removing "
+                + self.provider._safe_to_print_url(self._url_prefix + path_with_params),
+            )
+
+    def open_remote(self) -> RemoteFile:
+        """
+        Open the remote file for reading without staging it locally.
+
+        Only the blocks that are actually read are transferred, which is useful
+        if only a small part of a large file is needed.
+        """
+        settings = self.provider.settings
+        return RemoteFile(
+            str(self.url),
+            self.provider._check_status,
+            f"Error reading {self.provider._safe_to_print_url(self.query)}",
+            block_size=settings.stream_block_size,
+            cache_blocks=settings.stream_cache_blocks,
+            read_ahead=settings.stream_read_ahead,
+        )
+
+    def _remote_checksum(
+        self, path_with_params: Optional[str] = None
+    ) -> Optional[tuple[str, str]]:
+        """Return the (algorithm, value) checksum reported by the server."""
+        status, response = self.file_system.query(
+            QueryCode.CHECKSUM, path_with_params or self.url.path_with_params
+        )
+        if not status.ok or not response:
+            get_logger().debug(
+                "Could not query checksum of "
+                f"{self.provider._safe_to_print_url(self.query)}: {status.message}"
+            )
+            return None
+        if isinstance(response, bytes):
+            response = response.decode(errors="replace")
+        parts = response.strip("\x00 \n").split()
+        if len(parts) < 2:
+            return None
+        return parts[0].lower(), parts[1].lower()
+
+    def _checksums_match(
+        self, local_path: str, path_with_params: Optional[str] = None
+    ) -> Optional[bool]:
+        """
+        Compare the checksum of the local file with the one of the remote file
+        (by default this object).
+
+        Returns None if the server does not provide a checksum of type
+        checksum_type.
+        """
+        algorithm = self.provider.settings.checksum_type
+        remote = self._remote_checksum(path_with_params)
+        if remote is None or remote[0] != algorithm:
+            return None
+        local = self.provider._local_checksums.get(local_path, algorithm)
+        try:
+            return int(remote[1], 16) == int(local, 16)
+        except ValueError:
+            return None
+
+    def _is_unchanged(
+        self, local_path: str, stat_info: Optional[StatInfo] = None
+    ) -> bool:
+        """
+        Whether the local and the remote file are identical, compared by size
+        and checksum. Always False unless skip_unchanged_transfers is set.
+        The remote stat info is looked up unless given.
+        """
+        if not self.provider.settings.skip_unchanged_transfers:
+            return False
+        if not os.path.isfile(local_path):
+            return False
+        if stat_info is None:
+            stat_info = self._stat(self.url.path_with_params, allow_missing=True)
+        if (
+            stat_info is None
+            or stat_info.flags & StatInfoFlags.IS_DIR
+            or stat_info.size != os.path.getsize(local_path)
+        ):
+            return False
+        unchanged = bool(self._checksums_match(local_path))
+        if unchanged:
+            get_logger().debug(
+                "Skipping transfer of unchanged "
+                f"{self.provider._safe_to_print_url(self.query)}"
+            )
+        return unchanged
+
     # The following to methods are only required if the class inherits from
     # StorageObjectReadWrite.
 
@@ -478,32 +3341,197 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
     def store_object(self):
         # Ensure that the object is stored at the location specified by
         # self.local_path().
-        process = client.CopyProcess()
-        self._makedirs()
         local_path = os.path.abspath(self.local_path())
-        process.add_job(local_path, str(self.url), force=True)
-        process.prepare()
-        status, returns = process.run()
-        self.provider._check_status(
-            status, f"Error uploading to {self.provider._safe_to_print_url(self.query)}"
+        if os.path.isdir(local_path):
+            self._invalidate_metadata(recursive=True)
+            with self.provider._measure("store", self.query) as measurement:
+                nbytes = self._upload_directory(local_path)
+                if measurement is not None:
+                    measurement.nbytes = nbytes
+            return
+        if self._is_unchanged(local_path):
+            return
+        settings = self.provider.settings
+        if (
+            settings.small_file_threshold is not None
+            and not settings.resumable_transfers
+            and os.path.getsize(local_path) < settings.small_file_threshold
+        ):
+            self._invalidate_metadata()
+            with self.provider._measure("store", self.query) as measurement:
+                self._upload_small(local_path)
+                if measurement is not None:
+                    measurement.nbytes = os.path.getsize(local_path)
+            return
+        self._makedirs()
+        self._invalidate_metadata()
+        with self.provider._measure("store", self.query) as measurement:
+            if self.provider.settings.resumable_transfers:
+                self._upload_resumable(local_path)
+            else:
+                self.provider._transfer_batcher.transfer(
+                    local_path,
+                    str(self.url),
+                    "Error uploading to "
+                    f"{self.provider._safe_to_print_url(self.query)}",
+                )
+            if measurement is not None:
+                measurement.nbytes = os.path.getsize(local_path)
+
+    def _upload_small(self, local_path: str):
+        """
+        Upload a small file with one open, write and close request.
+
+        The file is opened with MAKEPATH, which replaces the directory check of
+        _makedirs(), and its content is passed to the client as a read-only
+        memory map, so it is not copied into a Python buffer first.
+        """
+        error_preamble = (
+            f"Error uploading to {self.provider._safe_to_print_url(self.query)}"
         )
-        self.provider._check_status(
-            returns[0]["status"],
-            f"Error uploading to {self.provider._safe_to_print_url(self.query)}",
+        handles = self.provider._small_upload_files
+        file = getattr(handles, "file", None)
+        if file is None:
+            file = handles.file = client.File()
+        status, _ = file.open(str(self.url), OpenFlags.DELETE | OpenFlags.MAKEPATH)
+        self.provider._check_status(status, error_preamble)
+        try:
+            with open(local_path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        status, _ = file.write(data, 0, size)
+                        self.provider._check_status(status, error_preamble)
+        finally:
+            status, _ = file.close()
+        self.provider._check_status(status, error_preamble)
+        self._add_created_directory(self.dirname)
+
+    @xrootd_retry
+    def copy_to(self, target: "StorageObject"):
+        """
+        Copy this object to another XRootD storage object.
+
+        The servers copy the data directly (third-party copy) if enabled and
+        supported, otherwise it is downloaded to the local storage prefix and
+        uploaded from there.
+        """
+        target._makedirs()
+        target._invalidate_metadata()
+        error_preamble = (
+            f"Error copying {self.provider._safe_to_print_url(self.query)} to "
+            f"{self.provider._safe_to_print_url(target.query)}"
         )
+        with self.provider._measure("copy", self.query):
+            if self.provider.settings.third_party_copy:
+                try:
+                    self._copy_third_party(target, error_preamble)
+                    return
+                except (WorkflowError, XRootDFatalException) as e:
+                    # Servers refuse third-party copies with various errors,
+                    # but fatal ones such as a missing source or a denied
+                    # target would only fail again after a full download.
+                    if (
+                        isinstance(e, XRootDFatalException)
+                        and getattr(e, "xrootd_errno", None) != UNSUPPORTED_ERRNO
+                    ):
+                        raise
+                    get_logger().info(
+                        f"{e}, falling back to copying through the local prefix"
+                    )
+            self._copy_two_hop(target, error_preamble)
+
+    def _copy_third_party(self, target: "StorageObject", error_preamble: str):
+        process = client.CopyProcess()
+        process.add_job(str(self.url), str(target.url), force=True, thirdparty="only")
+        self.provider._check_status(process.prepare(), error_preamble)
+        status, returns = process.run()
+        self.provider._check_status(status, error_preamble)
+        if not returns:
+            raise WorkflowError(f"{error_preamble}: no result")
+        self.provider._check_status(returns[0]["status"], error_preamble)
+
+    def _copy_two_hop(self, target: "StorageObject", error_preamble: str):
+        staging_dir = self.provider.local_prefix / ".xrootd-copy"
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        staging_path = str((staging_dir / uuid.uuid4().hex).absolute())
+        try:
+            self.provider._transfer_batcher.transfer(
+                str(self.url), staging_path, error_preamble
+            )
+            self.provider._transfer_batcher.transfer(
+                staging_path, str(target.url), error_preamble
+            )
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
 
     @xrootd_retry
     def remove(self):
         # Remove the object from the storage.
         stat = self._stat(self.url.path_with_params)
         if stat.flags & StatInfoFlags.IS_DIR:
-            rm_func = self.file_system.rmdir
+            self._remove_tree()
+        elif self.provider.settings.remove_dry_run:
+            get_logger().info(
+                f"Would remove {self.provider._safe_to_print_url(self.query)}"
+            )
         else:
-            rm_func = self.file_system.rm
-        status, _ = rm_func(self.url.path_with_params)
-        self.provider._check_status(
-            status, f"Error removing {self.provider._safe_to_print_url(self.query)}"
-        )
+            self._invalidate_metadata()
+            self._rm(self.url.path_with_params)
+
+    def _remove_tree(self) -> List[str]:
+        """
+        Remove this directory with everything below it, returning the removed
+        paths in order of removal (or the paths that would be removed if
+        remove_dry_run is set).
+
+        Files are removed concurrently first, then the directories level by
+        level, deepest first.
+        """
+        settings = self.provider.settings
+        root = self.path.rstrip("/")
+        if not root:
+            raise WorkflowError(
+                "XRootD Error: refusing to remove the root directory of "
+                f"{self.provider._safe_to_print_url(self.query)}"
+            )
+        files, dirs = self._list_tree()
+        if (
+            settings.remove_max_entries is not None
+            and len(files) + len(dirs) > settings.remove_max_entries
+        ):
+            raise WorkflowError(
+                f"XRootD Error: refusing to remove "
+                f"{self.provider._safe_to_print_url(self.query)}, it contains "
+                f"{len(files) + len(dirs)} entries, more than remove_max_entries="
+                f"{settings.remove_max_entries}"
+            )
+        levels = {}
+        for rel_path in dirs:
+            levels.setdefault(rel_path.count("/"), []).append(root + "/" + rel_path)
+        ordered = [[root + "/" + rel_path for rel_path in files]]
+        ordered += [levels[depth] for depth in sorted(levels, reverse=True)]
+        ordered.append([root])
+        removed = [path for paths in ordered for path in paths]
+        if settings.remove_dry_run:
+            for path in removed:
+                get_logger().info(
+                    "Would remove "
+                    + self.provider._safe_to_print_url(
+                        self._url_prefix + path + self._params
+                    )
+                )
+            return removed
+        self._invalidate_metadata(recursive=True)
+        for i, paths in enumerate(ordered):
+            is_dir = i > 0
+            _map_concurrently(
+                lambda path, is_dir=is_dir: self._rm(path + self._params, is_dir),
+                paths,
+                settings.remove_workers,
+            )
+        return removed
 
     # The following to methods are only required if the class inherits from
     # StorageObjectGlob.
@@ -516,54 +3544,105 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
         # prefix of the query before the first wildcard.
         const_prefix = get_constant_prefix(self.url.path, strip_incomplete_parts=True)
         glob_query = self._url_with_new_path(str(self.url), const_prefix)
-        yield from self._list_recursive(glob_query)
-
-    def _list_recursive(self, query: str, _depth: int = 0) -> Iterable[str]:
-        if _depth > self.provider.settings.glob_wildcards_max_depth:
-            raise WorkflowError(
-                "XRootD Error: directory nesting exceeds maximum depth of "
-                f"{self.provider.settings.glob_wildcards_max_depth} while listing "
-                f"{self.provider._safe_to_print_url(query)}"
-            )
+        matchers = _compile_segment_matchers(self.url.path[len(const_prefix) :])
+        yield from self._list_recursive(glob_query, matchers)
 
+    def _list_recursive(
+        self, query: str, matchers: Optional[List[Optional[re.Pattern]]] = None
+    ) -> Iterable[str]:
         url = URL(query)
         # First check if the path is a directory or a file. If it is a file, we can
-        # return it directly. (Only need to do this for the first call, since we check
-        # it before recursing into subdirectories.)
-        if _depth == 0:
-            stat_info = self._stat(url.path_with_params, allow_missing=True)
-            # Prefix does not exist, return nothing.
-            if stat_info is None:
-                return
-            if not stat_info.flags & StatInfoFlags.IS_DIR:
-                yield query
-                return
+        # return it directly. (Only need to do this for the prefix, since we check
+        # it before descending into subdirectories.)
+        stat_info = self._cached_stat(url.path_with_params, allow_missing=True)
+        # Prefix does not exist, return nothing.
+        if stat_info is None:
+            return
+        if not stat_info.flags & StatInfoFlags.IS_DIR:
+            yield query
+            return
+
+        # Breadth-first walk that keeps up to glob_workers directory listings in
+        # flight and yields files as soon as their directory has been listed.
+        # matchers[depth] restricts the entries of directories at that depth below
+        # the prefix, None (or running out of matchers) disables pruning.
+        # The walk only deals with paths, they share prefix and parameters with
+        # the query.
+        prefix, params = self._split_url(query)
+        matchers = matchers or []
+        max_depth = self.provider.settings.glob_wildcards_max_depth
+        executor = ThreadPoolExecutor(
+            max_workers=max(self.provider.settings.glob_workers, 1)
+        )
+        pending = {}
 
-        dirlist = self._dirlist(url.path_with_params)
+        def submit(path: str, depth: int):
+            if depth < len(matchers) and matchers[depth] is not None:
+                is_last = depth == len(matchers) - 1
+                future = executor.submit(
+                    self._list_dir, path, params, matchers[depth], is_last, not is_last
+                )
+            else:
+                future = executor.submit(self._list_dir, path, params)
+            pending[future] = depth
+
+        try:
+            submit(url.path, 0)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = pending.pop(future)
+                    files, subdirs = future.result()
+                    for file in files:
+                        yield prefix + file + params
+                    for subdir in subdirs:
+                        if depth + 1 > max_depth:
+                            raise WorkflowError(
+                                "XRootD Error: directory nesting exceeds maximum "
+                                f"depth of {max_depth} while listing "
+                                + self.provider._safe_to_print_url(
+                                    prefix + subdir + params
+                                )
+                            )
+                        submit(subdir, depth + 1)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _list_dir(
+        self,
+        path: str,
+        params: str = "",
+        matcher: Optional[re.Pattern] = None,
+        keep_files: bool = True,
+        keep_subdirs: bool = True,
+    ) -> tuple[List[str], List[str]]:
+        """List a directory, returning the paths of its files and subdirectories.
+
+        If a matcher is given, only entries whose name fully matches it are kept.
+        """
+        dirlist = self._cached_dirlist(path + params)
+        parent = path.rstrip("/") + "/"
 
+        files, subdirs = [], []
         for entry in dirlist.dirlist:
-            # Dirlist should never return entries with empty names or "." or ".." or
-            # names containing slashes, but we check for that anyway to be safe.
-            if (
-                not entry.name
-                or entry.name in (".", "..")
-                or "/" in entry.name
-                or "\\" in entry.name
-            ):
+            if self._is_suspicious_entry_name(entry.name):
                 get_logger().warning(
                     "Skipping suspicious directory entry name "
                     f"{entry.name!r} returned while listing "
-                    f"{self.provider._safe_to_print_url(query)}"
+                    + self.provider._safe_to_print_url(self._url_prefix + path + params)
                 )
                 continue
-
-            child_query = self._url_with_new_path(
-                str(url), url.path.rstrip("/") + "/" + entry.name
-            )
-            if (
+            is_dir = (
                 entry.statinfo is not None
                 and entry.statinfo.flags & StatInfoFlags.IS_DIR
-            ):
-                yield from self._list_recursive(child_query, _depth + 1)
+            )
+            if not (keep_subdirs if is_dir else keep_files):
+                continue
+            if matcher is not None and not matcher.fullmatch(entry.name):
+                continue
+
+            if is_dir:
+                subdirs.append(parent + entry.name)
             else:
-                yield child_query
+                files.append(parent + entry.name)
+        return files, subdirs
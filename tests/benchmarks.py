@@ -0,0 +1,579 @@
+"""Benchmarks against a local XRootD server.
+
+These are not part of the regular test run. Run them explicitly with
+``pytest -s tests/benchmarks.py``. If ``XROOTD_BENCHMARK_OUTPUT`` is set,
+every result is also appended as a JSON line to that file, so that results
+of different revisions can be compared.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+from XRootD import client
+
+from tests import (  # noqa: F401
+    XROOTD_TEST_PORT,
+    InventoryCache,
+    make_provider,
+    start_xrootd_server,
+)
+
+from snakemake_storage_plugin_xrootd import StorageObject, StorageProviderSettings
+
+N_FILES = 2000
+
+
+def report(name: str, **values):
+    print(f"{name}: " + ", ".join(f"{k}={v}" for k, v in values.items()))
+    output = os.environ.get("XROOTD_BENCHMARK_OUTPUT")
+    if output:
+        record = {
+            "benchmark": name,
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            **values,
+        }
+        with open(output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def test_benchmark_inventory_vs_stat(tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT)
+    )
+    base = tmp_path / "flat"
+    base.mkdir()
+    for i in range(N_FILES):
+        (base / f"f{i}.txt").write_text("x")
+    objs = [
+        provider.object(
+            query=f"root://localhost:{XROOTD_TEST_PORT}/{base}/f{i}.txt",
+            keep_local=False,
+            retrieve=False,
+        )
+        for i in range(N_FILES)
+    ]
+
+    start = time.perf_counter()
+    for obj in objs:
+        obj.exists()
+        obj.mtime()
+    stat_time = time.perf_counter() - start
+
+    async def inventory_all(cache):
+        for obj in objs:
+            await obj.inventory(cache)
+
+    cache = InventoryCache()
+    start = time.perf_counter()
+    asyncio.run(inventory_all(cache))
+    inventory_time = time.perf_counter() - start
+
+    assert all(cache.exists_in_storage[obj.cache_key()] for obj in objs)
+    report(
+        "inventory_vs_stat",
+        files=N_FILES,
+        stat_seconds=round(stat_time, 3),
+        inventory_seconds=round(inventory_time, 3),
+    )
+
+
+def test_benchmark_object_construction():
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT)
+    )
+    n_objects = 20000
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = [
+        provider.object(query=f"root://tmp/f{i}.txt", retrieve=False)
+        for i in range(n_objects)
+    ]
+    for obj in objs:
+        obj.file_system
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(provider._file_system_pool) == 1
+    report(
+        "object_construction",
+        objects=n_objects,
+        seconds=round(elapsed, 3),
+        peak_mib=round(peak / 2**20, 2),
+    )
+
+
+def test_benchmark_sync_vs_async_stat(tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT)
+    )
+    n_stats = 2000
+    (tmp_path / "f.txt").write_text("x")
+    obj = provider.object(
+        query=f"root://localhost:{XROOTD_TEST_PORT}/{tmp_path}/f.txt",
+        retrieve=False,
+    )
+    path = obj.url.path_with_params
+
+    start = time.perf_counter()
+    for _ in range(n_stats):
+        obj._stat(path)
+    sync_time = time.perf_counter() - start
+
+    async def stat_all():
+        await asyncio.gather(*(obj._stat_async(path) for _ in range(n_stats)))
+
+    start = time.perf_counter()
+    asyncio.run(stat_all())
+    async_time = time.perf_counter() - start
+
+    report(
+        "sync_vs_async_stat",
+        stats=n_stats,
+        sync_per_second=round(n_stats / sync_time),
+        async_per_second=round(n_stats / async_time),
+    )
+
+
+def make_tree(base, width, depth, files_per_dir=2):
+    """Create a tree with `width` subdirectories per level, `depth` levels deep."""
+    dirs = [base]
+    base.mkdir(parents=True, exist_ok=True)
+    for _ in range(depth):
+        next_dirs = []
+        for parent in dirs:
+            for i in range(width):
+                child = parent / f"d{i}"
+                child.mkdir()
+                next_dirs.append(child)
+        dirs = next_dirs
+    for leaf in dirs:
+        for i in range(files_per_dir):
+            (leaf / f"f{i}.txt").write_text("x")
+    return len(dirs) * files_per_dir
+
+
+def test_benchmark_glob_walker(tmp_path):
+    n_files = make_tree(tmp_path / "tree", width=6, depth=4)
+    query = f"root://localhost:{XROOTD_TEST_PORT}/{tmp_path}/tree/{{path}}.txt"
+
+    for workers in (1, 16):
+        provider = make_provider(
+            StorageProviderSettings(
+                host="localhost", port=XROOTD_TEST_PORT, glob_workers=workers
+            )
+        )
+        obj = provider.object(query=query, retrieve=False)
+        start = time.perf_counter()
+        matches = list(obj.list_candidate_matches())
+        elapsed = time.perf_counter() - start
+
+        assert len(matches) == n_files
+        report(
+            "glob_walker",
+            workers=workers,
+            files=n_files,
+            seconds=round(elapsed, 3),
+        )
+
+
+def test_benchmark_postprocess_query():
+    n_queries = 20000
+    queries = [f"root://host//data/run{i % 100}/f{i}.txt" for i in range(n_queries)]
+
+    for name, settings in (
+        ("plain", StorageProviderSettings()),
+        ("decorated", StorageProviderSettings(url_decorator="url + '?authz=x'")),
+    ):
+        provider = make_provider(settings)
+        start = time.perf_counter()
+        for query in queries:
+            provider.postprocess_query(query)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for query in queries:
+            provider.postprocess_query(query)
+        warm = time.perf_counter() - start
+        start = time.perf_counter()
+        for query in queries:
+            provider._parse_url_uncached(query)
+        uncached = time.perf_counter() - start
+
+        report(
+            "postprocess_query",
+            settings=name,
+            queries=n_queries,
+            uncached_seconds=round(uncached, 4),
+            cold_seconds=round(cold, 4),
+            warm_seconds=round(warm, 4),
+        )
+
+
+def test_benchmark_child_url_building():
+    n_children = 100000
+    parent = "root://user@host:1094//data/run1/?authz=token"
+    names = [f"f{i}.txt" for i in range(n_children)]
+
+    start = time.perf_counter()
+    for name in names:
+        StorageObject._url_with_new_path(parent, "/data/run1/" + name)
+    full_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prefix, params = StorageObject._split_url(parent)
+    for name in names:
+        prefix + "/data/run1/" + name + params
+    path_only = time.perf_counter() - start
+
+    report(
+        "child_url_building",
+        children=n_children,
+        full_parse_seconds=round(full_parse, 4),
+        path_only_seconds=round(path_only, 4),
+    )
+
+
+def test_benchmark_ranged_reads_vs_staging(tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=XROOTD_TEST_PORT,
+            stream_block_size=64 * 1024,
+            stream_read_ahead=0,
+        )
+    )
+    file_size = 64 * 2**20
+    (tmp_path / "big.bin").write_bytes(os.urandom(file_size))
+    obj = provider.object(
+        query=f"root://localhost:{XROOTD_TEST_PORT}/{tmp_path}/big.bin",
+        retrieve=False,
+    )
+    rng = random.Random(0)
+    # a header and some scattered reads, like reading a few branches
+    ranges = [(0, 64 * 1024)] + [
+        (rng.randrange(file_size - 4096), 4096) for _ in range(50)
+    ]
+
+    start = time.perf_counter()
+    with obj.open_remote() as f:
+        f.read_ranges(ranges)
+        fetched = f.bytes_fetched
+    ranged_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(obj.local_path()), exist_ok=True)
+    obj.retrieve_object()
+    with open(obj.local_path(), "rb") as f:
+        for offset, length in ranges:
+            f.seek(offset)
+            f.read(length)
+    staging_time = time.perf_counter() - start
+    os.remove(obj.local_path())
+
+    report(
+        "ranged_reads_vs_staging",
+        ranges=len(ranges),
+        ranged_bytes=fetched,
+        ranged_seconds=round(ranged_time, 3),
+        staged_bytes=file_size,
+        staging_seconds=round(staging_time, 3),
+    )
+
+
+def test_benchmark_stat_many(tmp_path, monkeypatch):
+    calls = []
+    for method in ("stat", "dirlist"):
+        orig = getattr(client.FileSystem, method)
+
+        def counting(self, *args, _orig=orig, **kwargs):
+            calls.append(1)
+            return _orig(self, *args, **kwargs)
+
+        monkeypatch.setattr(client.FileSystem, method, counting)
+
+    layouts = {
+        # 1000 files in 5 directories
+        "clustered": [f"d{i % 5}/f{i}.txt" for i in range(1000)],
+        # 200 files in directories of their own
+        "scattered": [f"d{i}/f{i}.txt" for i in range(200)],
+    }
+    for layout, paths in layouts.items():
+        base = tmp_path / layout
+        for path in paths:
+            (base / path).parent.mkdir(parents=True, exist_ok=True)
+            (base / path).write_text("x")
+        queries = [f"root://localhost:{XROOTD_TEST_PORT}/{base}/{p}" for p in paths]
+
+        for method in ("individual", "stat_many"):
+            provider = make_provider(
+                StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT)
+            )
+            calls.clear()
+            start = time.perf_counter()
+            if method == "stat_many":
+                provider.stat_many(queries)
+            for query in queries:
+                provider.object(query=query, retrieve=False).exists()
+            elapsed = time.perf_counter() - start
+            report(
+                "stat_many",
+                layout=layout,
+                method=method,
+                queries=len(queries),
+                calls_per_query=round(len(calls) / len(queries), 3),
+                seconds=round(elapsed, 3),
+            )
+
+
+def test_benchmark_stat_throughput(tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=XROOTD_TEST_PORT, max_requests_per_second=1e6
+        )
+    )
+    base = tmp_path / "stat"
+    base.mkdir()
+    for i in range(N_FILES):
+        (base / f"f{i}.txt").write_text("x")
+    objs = [
+        provider.object(
+            query=f"root://localhost:{XROOTD_TEST_PORT}/{base}/f{i}.txt",
+            retrieve=False,
+        )
+        for i in range(N_FILES)
+    ]
+
+    start = time.perf_counter()
+    assert all(obj.exists() for obj in objs)
+    sync_time = time.perf_counter() - start
+
+    async def exists_all():
+        return await asyncio.gather(*(obj.managed_exists() for obj in objs))
+
+    start = time.perf_counter()
+    assert all(asyncio.run(exists_all()))
+    managed_time = time.perf_counter() - start
+
+    report(
+        "stat_throughput",
+        objects=N_FILES,
+        sync_per_second=round(N_FILES / sync_time),
+        managed_per_second=round(N_FILES / managed_time),
+    )
+
+
+def test_benchmark_dirlist(tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT)
+    )
+    flat = tmp_path / "flat"
+    flat.mkdir()
+    n_entries = 10000
+    for i in range(n_entries):
+        (flat / f"f{i}.txt").write_text("x")
+    deep = tmp_path / "deep"
+    depth = 50
+    leaf = deep.joinpath(*(f"d{i}" for i in range(depth)))
+    leaf.mkdir(parents=True)
+    (leaf / "f.txt").write_text("x")
+
+    obj = provider.object(
+        query=f"root://localhost:{XROOTD_TEST_PORT}/{flat}/f0.txt", retrieve=False
+    )
+    start = time.perf_counter()
+    dirlist = obj._dirlist(str(flat))
+    flat_time = time.perf_counter() - start
+    assert len(dirlist.dirlist) == n_entries
+
+    obj = provider.object(
+        query=f"root://localhost:{XROOTD_TEST_PORT}/{deep}/{{path}}.txt",
+        retrieve=False,
+    )
+    start = time.perf_counter()
+    assert len(list(obj.list_candidate_matches())) == 1
+    deep_time = time.perf_counter() - start
+
+    report(
+        "dirlist",
+        flat_entries=n_entries,
+        flat_seconds=round(flat_time, 3),
+        deep_levels=depth,
+        deep_seconds=round(deep_time, 3),
+    )
+
+
+def test_benchmark_glob_layouts(tmp_path):
+    layouts = {
+        # name: (width, depth, files per directory)
+        "flat": (1, 0, 5000),
+        "wide": (40, 2, 3),
+        "deep": (2, 9, 1),
+    }
+    for layout, (width, depth, files_per_dir) in layouts.items():
+        base = tmp_path / layout
+        n_files = make_tree(base, width, depth, files_per_dir)
+        pattern = "/".join(["{dir,[^/]+}"] * depth + ["{name,[^/]+}.txt"])
+        provider = make_provider(
+            StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT)
+        )
+        for kind, query in (
+            ("unconstrained", f"{base}/{{path}}.txt"),
+            ("constrained", f"{base}/{pattern}"),
+        ):
+            obj = provider.object(
+                query=f"root://localhost:{XROOTD_TEST_PORT}/{query}", retrieve=False
+            )
+            start = time.perf_counter()
+            matches = list(obj.list_candidate_matches())
+            elapsed = time.perf_counter() - start
+            assert len(matches) == n_files
+            report(
+                "glob_layouts",
+                layout=layout,
+                pattern=kind,
+                files=n_files,
+                seconds=round(elapsed, 3),
+            )
+
+
+def test_benchmark_small_file_transfers(tmp_path):
+    n_files = 500
+    for batch_size in (1, 32):
+        provider = make_provider(
+            StorageProviderSettings(
+                host="localhost",
+                port=XROOTD_TEST_PORT,
+                transfer_batch_size=batch_size,
+            )
+        )
+        remote = tmp_path / f"small{batch_size}"
+        objs = [
+            provider.object(
+                query=f"root://localhost:{XROOTD_TEST_PORT}/{remote}/f{i}.txt",
+                retrieve=False,
+            )
+            for i in range(n_files)
+        ]
+        for obj in objs:
+            os.makedirs(os.path.dirname(obj.local_path()), exist_ok=True)
+            with open(obj.local_path(), "wb") as f:
+                f.write(os.urandom(4096))
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            start = time.perf_counter()
+            list(executor.map(lambda obj: obj.store_object(), objs))
+            store_time = time.perf_counter() - start
+            for obj in objs:
+                os.remove(obj.local_path())
+            start = time.perf_counter()
+            list(executor.map(lambda obj: obj.retrieve_object(), objs))
+            retrieve_time = time.perf_counter() - start
+
+        report(
+            "small_file_transfers",
+            files=n_files,
+            batch_size=batch_size,
+            store_per_second=round(n_files / store_time),
+            retrieve_per_second=round(n_files / retrieve_time),
+        )
+
+
+def test_benchmark_small_file_uploads(tmp_path):
+    n_files = 200
+    for file_size in (2**10, 2**14, 2**17, 2**20):
+        data = os.urandom(file_size)
+        for mode, threshold in (("copy", None), ("small_file", 2**20 + 1)):
+            provider = make_provider(
+                StorageProviderSettings(
+                    host="localhost",
+                    port=XROOTD_TEST_PORT,
+                    small_file_threshold=threshold,
+                )
+            )
+            remote = tmp_path / f"{mode}{file_size}"
+            objs = [
+                provider.object(
+                    query=f"root://localhost:{XROOTD_TEST_PORT}/{remote}/f{i}.bin",
+                    retrieve=False,
+                )
+                for i in range(n_files)
+            ]
+            for obj in objs:
+                os.makedirs(os.path.dirname(obj.local_path()), exist_ok=True)
+                with open(obj.local_path(), "wb") as f:
+                    f.write(data)
+
+            with ThreadPoolExecutor(max_workers=32) as executor:
+                start = time.perf_counter()
+                list(executor.map(lambda obj: obj.store_object(), objs))
+                elapsed = time.perf_counter() - start
+
+            report(
+                "small_file_uploads",
+                mode=mode,
+                file_size=file_size,
+                files=n_files,
+                objects_per_second=round(n_files / elapsed),
+            )
+
+
+def test_benchmark_large_file_transfers(tmp_path):
+    file_size = 256 * 2**20
+    (tmp_path / "large.bin").write_bytes(os.urandom(file_size))
+    for mode, settings in (
+        ("copy", {}),
+        ("chunked", {"parallel_download_threshold": 1}),
+        ("resumable", {"resumable_transfers": True}),
+    ):
+        provider = make_provider(
+            StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT, **settings)
+        )
+        obj = provider.object(
+            query=f"root://localhost:{XROOTD_TEST_PORT}/{tmp_path}/large.bin",
+            retrieve=False,
+        )
+        os.makedirs(os.path.dirname(obj.local_path()), exist_ok=True)
+        start = time.perf_counter()
+        obj.retrieve_object()
+        retrieve_time = time.perf_counter() - start
+        assert os.path.getsize(obj.local_path()) == file_size
+
+        target = provider.object(
+            query=f"root://localhost:{XROOTD_TEST_PORT}/{tmp_path}/{mode}/large.bin",
+            retrieve=False,
+        )
+        os.makedirs(os.path.dirname(target.local_path()), exist_ok=True)
+        os.replace(obj.local_path(), target.local_path())
+        start = time.perf_counter()
+        target.store_object()
+        store_time = time.perf_counter() - start
+        os.remove(target.local_path())
+
+        report(
+            "large_file_transfers",
+            mode=mode,
+            mib=file_size // 2**20,
+            retrieve_mib_per_second=round(file_size / 2**20 / retrieve_time, 1),
+            store_mib_per_second=round(file_size / 2**20 / store_time, 1),
+        )
+
+
+def test_benchmark_provider_construction():
+    n_providers = 1000
+    start = time.perf_counter()
+    for _ in range(n_providers):
+        make_provider(StorageProviderSettings(host="localhost", port=XROOTD_TEST_PORT))
+    elapsed = time.perf_counter() - start
+    report(
+        "provider_construction",
+        providers=n_providers,
+        microseconds_each=round(elapsed / n_providers * 1e6, 1),
+    )
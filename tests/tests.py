@@ -1,5 +1,12 @@
+import asyncio
+import hashlib
+import io
+import os
+import shutil
 import subprocess
+import threading
 import time
+import zlib
 from pathlib import Path
 from typing import Optional, Type
 
@@ -7,12 +14,31 @@ import pytest
 from snakemake.exceptions import WorkflowError
 from snakemake_interface_common.logging import get_logger
 from snakemake_interface_storage_plugins.tests import TestStorageBase
-from snakemake_interface_storage_plugins.storage_provider import StorageProviderBase
+from snakemake_interface_storage_plugins.storage_provider import (
+    Operation,
+    StorageProviderBase,
+)
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
+from XRootD import client
 
 from snakemake_storage_plugin_xrootd import (
+    AdaptiveThrottler,
+    FileSystemPool,
+    LocalChecksumCache,
+    MetadataCache,
+    NodeCache,
+    PARTIAL_SUFFIX,
+    RetryPolicy,
+    StorageObject,
     StorageProvider,
     StorageProviderSettings,
+    TransferBatcher,
+    XRootDFatalException,
+    XRootDMetrics,
+    XRootDOverloadError,
+    _compile_segment_matchers,
+    _regex_can_match_slash,
+    _xrootd_call,
 )
 import socket
 
@@ -29,28 +55,71 @@ def make_provider(settings: StorageProviderSettings) -> StorageProvider:
     )
 
 
-@pytest.fixture(scope="module", autouse=True)
-def start_xrootd_server():
-    """Starts an XRootD server for testing."""
-    proc = subprocess.Popen(["xrootd", "-p", str(XROOTD_TEST_PORT)])
+def count_calls(monkeypatch, *methods, with_paths=False, delay=0.0):
+    """
+    Record the calls of the given client.FileSystem methods, as method names
+    or, with with_paths, as (method, path without parameters) tuples. Every
+    call is delayed by delay seconds, to let concurrent calls overlap.
+    """
+    calls = []
+    for method in methods:
+        orig = getattr(client.FileSystem, method)
+
+        def counting(self, path, *args, _orig=orig, _method=method, **kwargs):
+            calls.append((_method, path.split("?")[0]) if with_paths else _method)
+            if delay:
+                time.sleep(delay)
+            return _orig(self, path, *args, **kwargs)
+
+        monkeypatch.setattr(client.FileSystem, method, counting)
+    return calls
+
+
+def write_xrootd_config(directory: Path) -> Path:
+    """Write a server config that enables third-party copies (off by default)."""
+    config = directory / "xrootd.cfg"
+    xrdcp = shutil.which("xrdcp")
+    config.write_text(f"ofs.tpc pgm {xrdcp} --server\n" if xrdcp else "")
+    return config
+
+
+def run_xrootd_server(port: int, config: Optional[Path] = None):
+    command = ["xrootd", "-p", str(port)]
+    if config is not None:
+        command += ["-c", str(config)]
+    proc = subprocess.Popen(command)
     start_time = time.time()
 
     while time.time() - start_time < 10:
         if proc.poll() is not None:
             pytest.fail("XRootD server terminated unexpectedly.")
         try:
-            with socket.create_connection(("localhost", XROOTD_TEST_PORT), timeout=1):
+            with socket.create_connection(("localhost", port), timeout=1):
                 break
         except Exception:
             time.sleep(0.1)
     else:
         pytest.fail("XRootD server did not start within 10 seconds.")
 
-    yield XROOTD_TEST_PORT
+    yield port
 
     proc.terminate()
 
 
+@pytest.fixture(scope="module", autouse=True)
+def start_xrootd_server(tmp_path_factory):
+    """Starts an XRootD server for testing."""
+    config = write_xrootd_config(tmp_path_factory.mktemp("xrootd"))
+    yield from run_xrootd_server(XROOTD_TEST_PORT, config)
+
+
+@pytest.fixture(scope="module")
+def second_xrootd_server(tmp_path_factory):
+    """Starts another XRootD server, e.g. as the target of third-party copies."""
+    config = write_xrootd_config(tmp_path_factory.mktemp("xrootd"))
+    yield from run_xrootd_server(XROOTD_TEST_PORT + 1, config)
+
+
 class TestStorage(TestStorageBase):
     __test__ = True
     retrieve_only = False  # set to True if the storage is read-only
@@ -139,6 +208,32 @@ def test_protocol_is_added_before_url_decorator():
     assert "saw_query=yes" in query
 
 
+def test_parse_url_is_memoized(monkeypatch):
+    provider = make_provider(StorageProviderSettings(protocol="krb5"))
+    calls = []
+    monkeypatch.setattr(provider, "dec_func", lambda url: calls.append(url) or url)
+
+    first = provider.postprocess_query("root://host//data/test.txt")
+    obj = provider.object(query=first, retrieve=False)
+    assert provider.postprocess_query("root://host//data/test.txt") == first
+    assert provider.postprocess_query(first) == first
+    assert len(calls) == 2
+    assert obj.get_inventory_parent() == "root://host:1094//data/?xrd.wantprot=krb5"
+
+
+def test_url_decorator_expression_is_compiled_once(monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(url_decorator="url + '?authz=anonymous'")
+    )
+    monkeypatch.setattr(
+        "builtins.compile", lambda *args: pytest.fail("decorator recompiled")
+    )
+    for i in range(3):
+        assert provider.postprocess_query(f"root://host//{i}.txt").endswith(
+            f"/{i}.txt?authz=anonymous"
+        )
+
+
 def test_safe_print_redacts_protocol_query_param():
     provider = make_provider(StorageProviderSettings(protocol="krb5,unix"))
 
@@ -188,3 +283,2156 @@ def test_list_candidate_matches_respects_depth_limit(start_xrootd_server, tmp_pa
 
     with pytest.raises(WorkflowError):
         list(obj.list_candidate_matches())
+
+
+class ExistsDict(dict):
+    def __init__(self):
+        super().__init__()
+        self.has_inventory = set()
+
+
+class InventoryCache:
+    """Minimal stand-in for Snakemake's IOCache."""
+
+    def __init__(self):
+        self.exists_local = ExistsDict()
+        self.exists_in_storage = ExistsDict()
+        self.mtime = {}
+        self.size = {}
+        self.checksum = {}
+
+
+def test_inventory_lists_parent_once(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+
+    base = tmp_path / "inventory_test"
+    base.mkdir()
+    for i in range(20):
+        (base / f"f{i}.txt").write_text(str(i))
+
+    calls = count_calls(monkeypatch, "stat", "dirlist")
+
+    cache = InventoryCache()
+    objs = [
+        provider.object(
+            query=f"root://localhost:{start_xrootd_server}/{base}/f{i}.txt",
+            keep_local=False,
+            retrieve=False,
+        )
+        for i in range(20)
+    ]
+    missing = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{base}/missing.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+    for obj in objs + [missing]:
+        asyncio.run(obj.inventory(cache))
+
+    assert calls == ["dirlist"]
+    for i, obj in enumerate(objs):
+        key = obj.cache_key()
+        assert cache.exists_in_storage[key]
+        assert cache.size[key] == len(str(i))
+        assert cache.mtime[key].storage() is not None
+    # Objects absent from a listed parent are known to be missing
+    assert missing.cache_key() not in cache.exists_in_storage
+    assert missing.get_inventory_parent() in cache.exists_in_storage.has_inventory
+
+
+def test_inventory_missing_parent(start_xrootd_server, tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/nodir/f.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+
+    cache = InventoryCache()
+    asyncio.run(obj.inventory(cache))
+
+    assert cache.exists_in_storage == {obj.cache_key(): False}
+    assert obj.get_inventory_parent() in cache.exists_in_storage.has_inventory
+
+
+def test_inventory_unlistable_parent(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    (tmp_path / "f.txt").write_text("abc")
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/f.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+
+    async def forbidden(func, *args, **kwargs):
+        return FakeStatus(ok=False, errno=3010, message="permission denied"), None
+
+    monkeypatch.setattr("snakemake_storage_plugin_xrootd._xrootd_call", forbidden)
+    cache = InventoryCache()
+    asyncio.run(obj.inventory(cache))
+
+    assert cache.exists_in_storage == {}
+    assert obj.get_inventory_parent() not in cache.exists_in_storage.has_inventory
+    assert obj.get_inventory_parent() not in provider._inventoried_parents
+    assert obj.exists() and obj.size() == 3
+
+
+class CountingFileSystem(client.FileSystem):
+    created = 0
+
+    def __init__(self, url):
+        CountingFileSystem.created += 1
+        super().__init__(url)
+
+
+def test_file_system_shared_per_endpoint(monkeypatch):
+    monkeypatch.setattr(client, "FileSystem", CountingFileSystem)
+    CountingFileSystem.created = 0
+    provider = make_provider(StorageProviderSettings())
+
+    objs = [
+        provider.object(query=f"root://host//data/f{i}.txt", retrieve=False)
+        for i in range(100)
+    ]
+    objs.append(provider.object(query="root://other//data/f.txt", retrieve=False))
+    for obj in objs:
+        obj.file_system
+
+    assert CountingFileSystem.created == 2
+    assert objs[0].file_system is objs[99].file_system
+    assert objs[0].file_system is not objs[100].file_system
+
+
+def test_file_system_pool_separates_auth_params(monkeypatch):
+    monkeypatch.setattr(client, "FileSystem", CountingFileSystem)
+    CountingFileSystem.created = 0
+    provider = make_provider(StorageProviderSettings())
+
+    a = provider.object(query="root://host//f.txt?authz=a", retrieve=False)
+    b = provider.object(query="root://host//f.txt?authz=b", retrieve=False)
+    c = provider.object(query="root://user@host//f.txt", retrieve=False)
+
+    assert len({id(a.file_system), id(b.file_system), id(c.file_system)}) == 3
+    assert CountingFileSystem.created == 3
+
+
+def test_file_system_pool_size_limit(monkeypatch):
+    monkeypatch.setattr(client, "FileSystem", CountingFileSystem)
+    CountingFileSystem.created = 0
+    pool = FileSystemPool(max_size=2, idle_timeout=300)
+
+    first = pool.get("root://a:1094//")
+    pool.get("root://b:1094//")
+    pool.get("root://a:1094//")
+    pool.get("root://c:1094//")
+
+    # b was the least recently used handle and got evicted
+    assert len(pool) == 2
+    assert pool.get("root://a:1094//") is first
+    assert CountingFileSystem.created == 3
+    pool.get("root://b:1094//")
+    assert CountingFileSystem.created == 4
+
+
+def test_file_system_pool_idle_eviction(monkeypatch):
+    monkeypatch.setattr(client, "FileSystem", CountingFileSystem)
+    CountingFileSystem.created = 0
+    now = [0.0]
+    pool = FileSystemPool(max_size=10, idle_timeout=60, clock=lambda: now[0])
+
+    first = pool.get("root://a:1094//")
+    now[0] = 30.0
+    assert pool.get("root://a:1094//") is first
+    now[0] = 50.0
+    pool.get("root://b:1094//")
+    now[0] = 100.0
+    pool.get("root://b:1094//")
+
+    # a has been idle for 70s and was dropped, b only for 50s
+    assert len(pool) == 1
+    assert pool.get("root://a:1094//") is not first
+    assert CountingFileSystem.created == 3
+
+
+class FakeStatus:
+    def __init__(self, ok=True, errno=0, message="", code=0):
+        self.ok = ok
+        self.errno = errno
+        self.message = message
+        self.code = code
+
+
+class FakeCopyProcess:
+    """Records jobs instead of copying; sources containing 'fail' fail."""
+
+    instances = []
+
+    def __init__(self):
+        self.jobs = []
+        self.n_parallel = None
+        FakeCopyProcess.instances.append(self)
+
+    def parallel(self, n):
+        self.n_parallel = n
+
+    def add_job(self, source, target, **kwargs):
+        self.jobs.append((source, target))
+
+    def prepare(self):
+        return FakeStatus()
+
+    def run(self, handler=None):
+        return FakeStatus(), [
+            {"status": FakeStatus(ok="fail" not in source, errno=3005, message="bad")}
+            for source, _ in self.jobs
+        ]
+
+
+def test_transfer_batcher_groups_concurrent_jobs(monkeypatch):
+    monkeypatch.setattr(client, "CopyProcess", FakeCopyProcess)
+    FakeCopyProcess.instances = []
+    provider = make_provider(
+        StorageProviderSettings(
+            transfer_batch_size=8, transfer_parallel=4, transfer_batch_linger=5
+        )
+    )
+    errors = {}
+
+    def transfer(i):
+        source = f"root://host//f{i}" + ("fail" if i == 3 else "")
+        try:
+            provider._transfer_batcher.transfer(source, f"/tmp/f{i}", f"job {i}")
+        except WorkflowError as e:
+            errors[i] = str(e)
+
+    threads = [threading.Thread(target=transfer, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(FakeCopyProcess.instances) == 1
+    assert len(FakeCopyProcess.instances[0].jobs) == 8
+    assert FakeCopyProcess.instances[0].n_parallel == 4
+    assert errors == {3: "job 3: bad"}
+
+
+def run_transfers(batcher, n):
+    errors = {}
+
+    def transfer(i):
+        try:
+            batcher.transfer(f"root://host//f{i}", f"/tmp/f{i}", f"job {i}")
+        except WorkflowError as e:
+            errors[i] = str(e)
+
+    threads = [threading.Thread(target=transfer, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_transfer_batcher_splits_batches(monkeypatch):
+    monkeypatch.setattr(client, "CopyProcess", FakeCopyProcess)
+    FakeCopyProcess.instances = []
+    batcher = TransferBatcher(
+        make_provider(StorageProviderSettings())._check_status,
+        batch_size=3,
+        parallel=2,
+        linger=0.2,
+    )
+
+    assert run_transfers(batcher, 7) == {}
+    sizes = [len(p.jobs) for p in FakeCopyProcess.instances]
+    assert sum(sizes) == 7 and max(sizes) <= 3
+    assert batcher._pending == []
+
+
+class SlowCopyProcess(FakeCopyProcess):
+    """Takes 0.3 seconds per run and tracks how many runs overlap."""
+
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def run(self, handler=None):
+        cls = SlowCopyProcess
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.3)
+        with cls.lock:
+            cls.active -= 1
+        return super().run(handler)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_transfer_batcher_runs_concurrently(monkeypatch, batch_size):
+    monkeypatch.setattr(client, "CopyProcess", SlowCopyProcess)
+    FakeCopyProcess.instances = []
+    SlowCopyProcess.max_active = 0
+    # default settings apart from the batch size
+    settings = StorageProviderSettings(transfer_batch_size=batch_size)
+    provider = make_provider(settings)
+
+    start = time.monotonic()
+    assert run_transfers(provider._transfer_batcher, 8) == {}
+    elapsed = time.monotonic() - start
+
+    assert len(FakeCopyProcess.instances) == 8 // batch_size
+    assert SlowCopyProcess.max_active > 1
+    # running one copy process after another would take at least 2.4 s
+    assert elapsed < 0.3 * 8 / batch_size / 2
+
+
+def test_batched_store_and_retrieve(start_xrootd_server, tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            transfer_batch_size=10,
+            transfer_parallel=4,
+        )
+    )
+    remote = tmp_path / "batched"
+    objs = []
+    for i in range(10):
+        obj = provider.object(
+            query=f"root://localhost:{start_xrootd_server}/{remote}/f{i}.txt",
+            retrieve=False,
+        )
+        obj.local_path().parent.mkdir(parents=True, exist_ok=True)
+        obj.local_path().write_text(str(i))
+        objs.append(obj)
+
+    def run_all(method):
+        threads = [threading.Thread(target=getattr(obj, method)) for obj in objs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    run_all("store_object")
+    assert sorted(p.name for p in remote.iterdir()) == sorted(
+        f"f{i}.txt" for i in range(10)
+    )
+
+    for obj in objs:
+        obj.local_path().unlink()
+    run_all("retrieve_object")
+    assert [obj.local_path().read_text() for obj in objs] == [str(i) for i in range(10)]
+
+
+def test_xrootd_call_awaits_callback_from_other_thread():
+    def fake_call(path, callback=None):
+        threading.Timer(0.01, callback, (FakeStatus(), f"info {path}", None)).start()
+        return FakeStatus()
+
+    status, response = asyncio.run(_xrootd_call(fake_call, "/f"))
+
+    assert status.ok
+    assert response == "info /f"
+
+
+def test_xrootd_call_returns_submission_error():
+    def fake_call(path, callback=None):
+        return FakeStatus(ok=False, errno=3005, message="submission failed")
+
+    status, response = asyncio.run(_xrootd_call(fake_call, "/f"))
+
+    assert not status.ok
+    assert response is None
+
+
+def test_async_metadata_operations(start_xrootd_server, tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, max_requests_per_second=1000
+        )
+    )
+    base = tmp_path / "async_test"
+    base.mkdir()
+    for i in range(50):
+        (base / f"f{i}.txt").write_text("x" * i)
+
+    def obj(name):
+        return provider.object(
+            query=f"root://localhost:{start_xrootd_server}/{base}/{name}",
+            retrieve=False,
+        )
+
+    objs = [obj(f"f{i}.txt") for i in range(50)]
+
+    async def check_all():
+        return await asyncio.gather(
+            *(o.managed_exists() for o in objs),
+            *(o.managed_size() for o in objs),
+            obj("missing.txt").managed_exists(),
+        )
+
+    results = asyncio.run(check_all())
+
+    assert results[:50] == [True] * 50
+    assert results[50:100] == list(range(50))
+    assert results[100] is False
+    assert asyncio.run(objs[1].managed_mtime()) == objs[1].mtime()
+
+
+def test_rate_limiter_keyed_per_endpoint():
+    provider = make_provider(StorageProviderSettings())
+
+    a = provider.postprocess_query("root://a.example.org//f.txt")
+    a2 = provider.postprocess_query("root://a.example.org//other/g.txt")
+    b = provider.postprocess_query("root://b.example.org:2094//f.txt")
+
+    assert provider.rate_limiter_key(a, Operation.EXISTS) == "a.example.org:1094"
+    assert provider.rate_limiter(a, Operation.EXISTS) is provider.rate_limiter(
+        a2, Operation.MTIME
+    )
+    assert provider.rate_limiter_key(b, Operation.EXISTS) == "b.example.org:2094"
+    assert provider.rate_limiter(a, Operation.EXISTS) is not provider.rate_limiter(
+        b, Operation.EXISTS
+    )
+
+
+def test_rate_limiter_per_host_overrides():
+    provider = make_provider(
+        StorageProviderSettings(
+            max_requests_per_second=5,
+            host_max_requests_per_second="a.example.org=50, b.example.org:2094=20",
+        )
+    )
+
+    assert provider._max_requests_per_second("a.example.org:1094") == 50
+    assert provider._max_requests_per_second("b.example.org:2094") == 20
+    assert provider._max_requests_per_second("b.example.org:1094") == 5
+    assert provider._max_requests_per_second("c.example.org:1094") == 5
+
+
+@pytest.mark.parametrize("spec", ["a.example.org", "a.example.org=fast", "=3", "a=0"])
+def test_rate_limiter_invalid_host_overrides(spec):
+    with pytest.raises(WorkflowError):
+        make_provider(StorageProviderSettings(host_max_requests_per_second=spec))
+
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_rate_limiter_throughput_scales_with_endpoints(adaptive):
+    n_requests = 40
+
+    async def simulated_requests(n_endpoints):
+        provider = make_provider(
+            StorageProviderSettings(
+                max_requests_per_second=20, adaptive_rate_limit=adaptive
+            )
+        )
+        queries = [
+            provider.postprocess_query(f"root://host{i % n_endpoints}//f{i}.txt")
+            for i in range(n_requests)
+        ]
+
+        async def request(query):
+            async with provider.rate_limiter(query, Operation.EXISTS):
+                # simulated server round trip
+                await asyncio.sleep(0.001)
+
+        start = time.monotonic()
+        await asyncio.gather(*(request(q) for q in queries))
+        return time.monotonic() - start
+
+    one_endpoint = asyncio.run(simulated_requests(1))
+    four_endpoints = asyncio.run(simulated_requests(4))
+
+    # 40 requests at 20/s on a single endpoint take about a second, spread over
+    # four independent endpoints a quarter of that at most
+    assert one_endpoint > 0.9
+    assert four_endpoints < one_endpoint / 2
+
+
+def test_adaptive_throttler_backs_off_and_recovers():
+    throttler = AdaptiveThrottler(max_rate=1000, increase_step=100)
+
+    async def request(error=None):
+        async with throttler:
+            if error is not None:
+                raise error
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(XRootDOverloadError):
+                await request(XRootDOverloadError("overloaded"))
+        overloaded_rate = throttler.rate
+        # other errors do not influence the rate
+        with pytest.raises(WorkflowError):
+            await request(WorkflowError("not found"))
+        assert throttler.rate == overloaded_rate
+        for _ in range(10):
+            await request()
+        return overloaded_rate
+
+    overloaded_rate = asyncio.run(scenario())
+
+    assert overloaded_rate == 125
+    assert throttler.rate == 1000
+
+
+def test_check_status_classifies_overload():
+    provider = make_provider(StorageProviderSettings())
+
+    with pytest.raises(XRootDOverloadError):
+        provider._check_status(FakeStatus(ok=False, errno=3024), "busy")
+    with pytest.raises(XRootDOverloadError):
+        provider._check_status(FakeStatus(ok=False, code=206), "expired")
+
+
+def test_list_candidate_matches_parallel_and_streaming(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, glob_workers=4
+        )
+    )
+    base = tmp_path / "wide"
+    for i in range(8):
+        for j in range(4):
+            sub = base / f"d{i}" / f"e{j}"
+            sub.mkdir(parents=True)
+            (sub / "f.txt").write_text("f")
+
+    lock = threading.Lock()
+    state = {"active": 0, "max_active": 0, "calls": 0}
+    orig_dirlist = client.FileSystem.dirlist
+
+    def slow_dirlist(self, *args, **kwargs):
+        with lock:
+            state["active"] += 1
+            state["calls"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+        time.sleep(0.02)
+        try:
+            return orig_dirlist(self, *args, **kwargs)
+        finally:
+            with lock:
+                state["active"] -= 1
+
+    monkeypatch.setattr(client.FileSystem, "dirlist", slow_dirlist)
+
+    query = f"root://localhost:{start_xrootd_server}/{base}/{{d}}/{{e}}/f.txt"
+    obj = provider.object(query=query, keep_local=False, retrieve=False)
+    matches = obj.list_candidate_matches()
+
+    first = next(matches)
+    # Results are streamed before the whole tree (1 + 8 + 32 dirs) is listed
+    assert state["calls"] < 41
+    matches = [first] + list(matches)
+
+    assert len(matches) == 32
+    assert all(m.endswith("/f.txt") for m in matches)
+    assert state["calls"] == 41
+    assert 1 < state["max_active"] <= 4
+
+
+def test_compile_segment_matchers():
+    matchers = _compile_segment_matchers(r"{run,[^/]+}/raw/{sample,\w+}.root")
+    assert [m.pattern for m in matchers] == [
+        "(?:[^/]+)",
+        "raw",
+        r"(?:\w+)\.root",
+    ]
+
+    # Multiple wildcards in one segment
+    (matcher,) = _compile_segment_matchers(r"{a,\d+}_{b,[a-z]+}.txt")
+    assert matcher.fullmatch("12_ab.txt")
+    assert not matcher.fullmatch("ab_12.txt")
+
+    # Unconstrained wildcards may contain a slash, so everything from their
+    # segment on has to be walked
+    assert _compile_segment_matchers("{run}/raw/{sample}.root") == [None] * 3
+    matchers = _compile_segment_matchers("{a,[^/]+}/{b,.*}/c.txt")
+    assert matchers[0].pattern == "(?:[^/]+)"
+    assert matchers[1:] == [None, None]
+    assert _compile_segment_matchers("") == []
+
+
+@pytest.mark.parametrize(
+    "regex,can_match_slash",
+    [
+        ("[^/]+", False),
+        (r"\w+", False),
+        (r"\d{4}", False),
+        ("(a|b)c", False),
+        (".+", True),
+        ("a|b/", True),
+        ("[a-z/]+", True),
+        (r"\S+", True),
+        ("[^a]", True),
+    ],
+)
+def test_regex_can_match_slash(regex, can_match_slash):
+    assert _regex_can_match_slash(regex) is can_match_slash
+
+
+def make_run_tree(base):
+    for run in ("run1", "run2", "other"):
+        for kind in ("raw", "reco", "tmp"):
+            d = base / run / kind
+            d.mkdir(parents=True)
+            (d / "a.root").write_text("a")
+            (d / "b.root").write_text("b")
+            (d / "deeper").mkdir()
+            (d / "deeper" / "c.root").write_text("c")
+
+
+def test_list_candidate_matches_prunes_constrained_wildcards(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    make_run_tree(tmp_path)
+    listed = count_calls(monkeypatch, "dirlist")
+
+    query = (
+        f"root://localhost:{start_xrootd_server}/{tmp_path}/"
+        "{run,run[0-9]}/raw/{sample,[^/]+}.root"
+    )
+    obj = provider.object(query=query, keep_local=False, retrieve=False)
+    matches = sorted(
+        m.rsplit(str(tmp_path), 1)[1] for m in obj.list_candidate_matches()
+    )
+
+    assert matches == [
+        "/run1/raw/a.root",
+        "/run1/raw/b.root",
+        "/run2/raw/a.root",
+        "/run2/raw/b.root",
+    ]
+    # the prefix, run1, run2, run1/raw and run2/raw, but nothing below or beside
+    assert len(listed) == 5
+
+
+def test_list_candidate_matches_spanning_wildcard_walks_everything(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    make_run_tree(tmp_path)
+    listed = count_calls(monkeypatch, "dirlist")
+
+    query = (
+        f"root://localhost:{start_xrootd_server}/{tmp_path}/{{run}}/raw/{{sample}}.root"
+    )
+    obj = provider.object(query=query, keep_local=False, retrieve=False)
+    matches = list(obj.list_candidate_matches())
+
+    # {run} may contain slashes, so the whole tree has to be listed
+    assert len(matches) == 27
+    assert len(listed) == 1 + 3 + 9 + 9
+
+
+class FakeStatInfo:
+    def __init__(self, size, modtime=1000.0, flags=0):
+        self.size = size
+        self.modtime = modtime
+        self.flags = flags
+
+
+class FakeListEntry:
+    def __init__(self, name, statinfo):
+        self.name = name
+        self.statinfo = statinfo
+
+
+class FakeDirectoryList:
+    def __init__(self, entries):
+        self.dirlist = entries
+
+
+def test_metadata_cache_ttl_and_invalidation(tmp_path):
+    now = [0.0]
+    cache = MetadataCache(str(tmp_path / "cache.sqlite"), ttl=10, clock=lambda: now[0])
+    key = "root://host:1094/data/a.txt"
+
+    assert cache.get_stat(key) is None
+    cache.put_stat(key, FakeStatInfo(3))
+    assert cache.get_stat(key).size == 3
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    now[0] = 11
+    assert cache.get_stat(key) is None
+
+    cache.put_dirlist(
+        "root://host:1094/data",
+        FakeDirectoryList(
+            [FakeListEntry("a.txt", FakeStatInfo(5)), FakeListEntry("b", None)]
+        ),
+    )
+    listing = cache.get_dirlist("root://host:1094/data")
+    assert [(e.name, e.statinfo and e.statinfo.size) for e in listing.dirlist] == [
+        ("a.txt", 5),
+        ("b", None),
+    ]
+    # listing a directory also caches the stat results of its entries
+    assert cache.get_stat(key).size == 5
+
+    cache.invalidate(key)
+    assert cache.get_stat(key) is None
+    assert cache.get_dirlist("root://host:1094/data") is None
+    assert cache.get_dirlist("root://host:1094/dat") is None
+
+    # invalidating a directory recursively forgets everything below it
+    cache.put_stat(key, FakeStatInfo(3))
+    cache.put_stat("root://host:1094/database", FakeStatInfo(4))
+    cache.put_dirlist("root://host:1094/data/sub", FakeDirectoryList([]))
+    cache.invalidate("root://host:1094/data", recursive=True)
+    assert cache.get_stat(key) is None
+    assert cache.get_dirlist("root://host:1094/data/sub") is None
+    assert cache.get_stat("root://host:1094/database").size == 4
+
+
+def test_metadata_cache_invalidates_directory_contents_on_store(
+    start_xrootd_server, tmp_path
+):
+    settings = StorageProviderSettings(
+        host="localhost",
+        port=start_xrootd_server,
+        metadata_cache_ttl=3600,
+        metadata_cache_path=str(tmp_path / "metadata.sqlite"),
+    )
+    remote = tmp_path / "remote"
+    query = f"root://localhost:{start_xrootd_server}/{remote}/dir"
+    obj = make_provider(settings).object(query=query, keep_local=False, retrieve=False)
+    local = Path(obj.local_path())
+    (local / "sub").mkdir(parents=True)
+    (local / "a.txt").write_text("abc")
+    (local / "sub" / "b.txt").write_text("de")
+    obj.store_object()
+    assert obj.size() == 5
+
+    (local / "sub" / "b.txt").write_text("defghij")
+    (local / "c.txt").write_text("k")
+    obj.store_object()
+    assert obj.size() == 11
+
+    obj.remove()
+    assert not obj.exists()
+
+
+def test_metadata_cache_persists_and_invalidates_on_store(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    settings = StorageProviderSettings(
+        host="localhost",
+        port=start_xrootd_server,
+        metadata_cache_ttl=3600,
+        metadata_cache_path=str(tmp_path / "metadata.sqlite"),
+    )
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "a.txt").write_text("abc")
+    query = f"root://localhost:{start_xrootd_server}/{remote}/a.txt"
+
+    calls = count_calls(monkeypatch, "stat")
+
+    obj = make_provider(settings).object(query=query, keep_local=False, retrieve=False)
+    assert obj.exists()
+    assert obj.size() == 3
+    assert len(calls) == 1
+
+    # A new provider, as in a later Snakemake invocation, reuses the results.
+    provider = make_provider(settings)
+    obj = provider.object(query=query, keep_local=False, retrieve=False)
+    assert obj.size() == 3
+    assert asyncio.run(obj.managed_size()) == 3
+    assert len(calls) == 1
+    assert provider._metadata_cache.hits == 2
+
+    # Uploading through the plugin invalidates the cached entry.
+    local = Path(obj.local_path())
+    local.parent.mkdir(parents=True, exist_ok=True)
+    local.write_text("abcdef")
+    obj.store_object()
+    assert obj.size() == 6
+
+    # Missing objects are not cached.
+    missing = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}/missing.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+    assert not missing.exists()
+    (remote / "missing.txt").write_text("x")
+    assert missing.exists()
+
+
+def test_local_checksum_cache(tmp_path, monkeypatch):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"x" * 1000)
+    cache = LocalChecksumCache(block_size=64)
+
+    assert cache.get(str(path), "adler32") == f"{zlib.adler32(b'x' * 1000):08x}"
+    assert cache.get(str(path), "md5") == hashlib.md5(b"x" * 1000).hexdigest()
+
+    opened = []
+    orig_open = open
+
+    def counting_open(*args, **kwargs):
+        opened.append(args[0])
+        return orig_open(*args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", counting_open)
+    cache.get(str(path), "adler32")
+    assert opened == []
+
+    # a modified file is checksummed again
+    path.write_bytes(b"y" * 1001)
+    assert cache.get(str(path), "adler32") == f"{zlib.adler32(b'y' * 1001):08x}"
+    assert len(opened) == 1
+
+
+@pytest.mark.parametrize("skip", [False, True])
+def test_retrieve_stats_only_when_needed(
+    start_xrootd_server, tmp_path, monkeypatch, skip
+):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            skip_unchanged_transfers=skip,
+        )
+    )
+    (tmp_path / "a.txt").write_text("abc")
+    query = f"root://localhost:{start_xrootd_server}/{tmp_path}/a.txt"
+    obj = provider.object(query=query, keep_local=False, retrieve=False)
+    local = Path(obj.local_path())
+    local.parent.mkdir(parents=True, exist_ok=True)
+    local.write_text("abd")
+    calls = count_calls(monkeypatch, "stat")
+
+    obj.retrieve_object()
+    assert local.read_text() == "abc"
+    # only checking for unchanged files needs the stat info, and only once
+    assert len(calls) == (1 if skip else 0)
+
+    # results of stat_many() are reused
+    provider.stat_many([query])
+    del calls[:]
+    local.write_text("abd")
+    obj.retrieve_object()
+    assert local.read_text() == "abc"
+    assert calls == []
+
+
+def test_invalid_checksum_type():
+    with pytest.raises(WorkflowError):
+        make_provider(StorageProviderSettings(checksum_type="sha512"))
+
+
+@pytest.mark.parametrize("skip", [False, True])
+def test_skip_unchanged_transfers(start_xrootd_server, tmp_path, monkeypatch, skip):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            skip_unchanged_transfers=skip,
+        )
+    )
+    transfers = []
+    orig_transfer = TransferBatcher.transfer
+
+    def counting_transfer(self, source, target, *args, **kwargs):
+        transfers.append(source)
+        return orig_transfer(self, source, target, *args, **kwargs)
+
+    monkeypatch.setattr(TransferBatcher, "transfer", counting_transfer)
+
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "a.txt").write_text("abc")
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}/a.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+    local = Path(obj.local_path())
+    local.parent.mkdir(parents=True, exist_ok=True)
+    local.write_text("abc")
+
+    obj.retrieve_object()
+    obj.store_object()
+    assert len(transfers) == (0 if skip else 2)
+
+    # same size, different content
+    local.write_text("abd")
+    obj.store_object()
+    assert (remote / "a.txt").read_text() == "abd"
+    (remote / "a.txt").write_text("xyz")
+    obj.retrieve_object()
+    assert local.read_text() == "xyz"
+    assert len(transfers) == (2 if skip else 4)
+
+
+def test_metrics_disabled(start_xrootd_server, tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    (tmp_path / "a.txt").write_text("abc")
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/a.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+    assert obj.size() == 3
+    assert provider._metrics is None
+    # the same no-op context manager is used for every operation
+    assert provider._measure("stat", obj.query) is provider._measure("rm", obj.query)
+
+
+def test_metrics_enabled(start_xrootd_server, tmp_path, monkeypatch):
+    recorded = []
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    provider._metrics = XRootDMetrics(sink=lambda *args: recorded.append(args))
+    endpoint = f"localhost:{start_xrootd_server}"
+    monkeypatch.setattr("time.sleep", lambda _: None)
+
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "a.txt").write_text("abc")
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}/a.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    obj.retrieve_object()
+    obj.store_object()
+    assert obj.size() == 3
+    obj.remove()
+
+    missing = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}/missing.txt",
+        keep_local=False,
+        retrieve=False,
+    )
+    with pytest.raises(XRootDFatalException):
+        missing.size()
+
+    # fail the first stat with a retryable error
+    orig_stat = client.FileSystem.stat
+    failures = [FakeStatus(ok=False, errno=3005, message="io error")]
+
+    def flaky_stat(self, *args, **kwargs):
+        if failures:
+            return failures.pop(), None
+        return orig_stat(self, *args, **kwargs)
+
+    monkeypatch.setattr(client.FileSystem, "stat", flaky_stat)
+    (remote / "b.txt").write_text("b")
+    provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}/b.txt",
+        keep_local=False,
+        retrieve=False,
+    ).size()
+
+    stats = provider._metrics.stats
+    assert stats[("retrieve", endpoint)].count == 1
+    assert stats[("retrieve", endpoint)].nbytes == 3
+    assert stats[("store", endpoint)].nbytes == 3
+    assert stats[("remove", endpoint)].count == 1
+    stat = stats[("stat", endpoint)]
+    assert stat.retries == 1
+    assert stat.errors == {3011: 1, 3005: 1}
+    assert sum(stat.histogram) == stat.count
+    assert len(recorded) == sum(s.count for s in stats.values())
+    # retrieving a file copies it right away, without a stat first
+    assert [args[:2] for args in recorded[:1]] == [("retrieve", endpoint)]
+    summary = provider._metrics.summary()
+    assert f"stat {endpoint}" in summary and "1 retries" in summary
+
+
+def test_metrics_sink_entry_point():
+    provider = make_provider(StorageProviderSettings(metrics_sink="builtins:print"))
+    assert provider._metrics.sink is print
+    with pytest.raises(WorkflowError):
+        make_provider(StorageProviderSettings(metrics_sink="nonexisting:sink"))
+
+
+def test_open_remote_reads_on_demand(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            stream_block_size=100,
+            stream_cache_blocks=4,
+            stream_read_ahead=1,
+        )
+    )
+    data = bytes(range(256)) * 10
+    (tmp_path / "big.bin").write_bytes(data)
+    requests = []
+    orig_vector_read = client.File.vector_read
+
+    def counting_vector_read(self, chunks, *args, **kwargs):
+        requests.append(list(chunks))
+        return orig_vector_read(self, chunks, *args, **kwargs)
+
+    monkeypatch.setattr(client.File, "vector_read", counting_vector_read)
+
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/big.bin",
+        retrieve=False,
+    )
+    with obj.open_remote() as f:
+        assert f.size == len(data)
+        assert f.read(10) == data[:10]
+        # block 0 and the read-ahead block 1
+        assert requests == [[(0, 100), (100, 100)]]
+        assert f.read(150) == data[10:160]
+        assert len(requests) == 1
+
+        f.seek(-5, io.SEEK_END)
+        assert f.read() == data[-5:]
+        assert requests[-1] == [(2500, 60)]
+
+        assert f.read_ranges([(1000, 10), (2000, 300), (2555, 100)]) == [
+            data[1000:1010],
+            data[2000:2300],
+            data[2555:],
+        ]
+        # all missing blocks in a single request
+        assert requests[-1] == [(1000, 100), (2000, 100), (2100, 100), (2200, 100)]
+        assert f.bytes_fetched == 660
+        assert len(f._blocks) == 4
+
+
+def test_open_remote_missing_file(start_xrootd_server, tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/missing.bin",
+        retrieve=False,
+    )
+    with pytest.raises(XRootDFatalException):
+        obj.open_remote()
+
+
+def make_chunked_download(server_port, tmp_path, size=1050):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=server_port,
+            parallel_download_threshold=1000,
+            parallel_download_streams=3,
+            parallel_download_chunk_size=100,
+        )
+    )
+    data = os.urandom(size)
+    (tmp_path / "large.bin").write_bytes(data)
+    obj = provider.object(
+        query=f"root://localhost:{server_port}/{tmp_path}/large.bin",
+        retrieve=False,
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    return obj, data
+
+
+def test_chunked_download_resumes_failed_chunks(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    obj, data = make_chunked_download(start_xrootd_server, tmp_path)
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    reads = []
+    failed = []
+    orig_read = client.File.read
+
+    def flaky_read(self, offset=0, size=0, *args, **kwargs):
+        reads.append(offset)
+        if offset == 500 and not failed:
+            failed.append(offset)
+            return FakeStatus(ok=False, errno=3005, message="io error"), None
+        return orig_read(self, offset, size, *args, **kwargs)
+
+    monkeypatch.setattr(client.File, "read", flaky_read)
+    obj.retrieve_object()
+
+    assert Path(obj.local_path()).read_bytes() == data
+    # only the failed chunk was fetched a second time
+    assert sorted(reads) == sorted(list(range(0, 1050, 100)) + [500])
+
+
+def test_chunked_download_small_files_use_copy(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    obj, data = make_chunked_download(start_xrootd_server, tmp_path, size=999)
+    monkeypatch.setattr(
+        client.File, "read", lambda *args, **kwargs: pytest.fail("chunked download")
+    )
+    obj.retrieve_object()
+    assert Path(obj.local_path()).read_bytes() == data
+
+
+def test_chunked_download_checksum_mismatch(start_xrootd_server, tmp_path, monkeypatch):
+    obj, _ = make_chunked_download(start_xrootd_server, tmp_path)
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    monkeypatch.setattr(obj, "_remote_checksum", lambda path=None: ("adler32", "1"))
+
+    with pytest.raises(WorkflowError, match="checksum"):
+        obj.retrieve_object()
+    assert not os.path.exists(obj.local_path())
+
+
+class Interrupted(BaseException):
+    """Simulates the job being killed, escapes the retry decorator."""
+
+
+def make_resumable(server_port, tmp_path, monkeypatch, size=1050):
+    monkeypatch.setattr("snakemake_storage_plugin_xrootd.TRANSFER_PIECE_SIZE", 100)
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=server_port, resumable_transfers=True
+        )
+    )
+    data = os.urandom(size)
+    obj = provider.object(
+        query=f"root://localhost:{server_port}/{tmp_path}/remote/file.bin",
+        retrieve=False,
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    return obj, data
+
+
+def interrupt_at(monkeypatch, method, offset_arg, failing_offset, error=None):
+    calls = []
+    orig = getattr(client.File, method)
+
+    def interrupted(self, *args, **kwargs):
+        offset = args[offset_arg]
+        calls.append(offset)
+        if offset == failing_offset and calls.count(offset) == 1:
+            if error is None:
+                raise Interrupted()
+            return error, None
+        return orig(self, *args, **kwargs)
+
+    monkeypatch.setattr(client.File, method, interrupted)
+    return calls
+
+
+def test_resumable_download_continues_after_interruption(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    obj, data = make_resumable(start_xrootd_server, tmp_path, monkeypatch)
+    (tmp_path / "remote").mkdir()
+    (tmp_path / "remote" / "file.bin").write_bytes(data)
+    reads = interrupt_at(monkeypatch, "read", 0, 500)
+
+    with pytest.raises(Interrupted):
+        obj.retrieve_object()
+    assert not os.path.exists(obj.local_path())
+    assert os.path.getsize(f"{obj.local_path()}.xrootd-part") == 500
+
+    # a new Snakemake invocation continues at the recorded offset
+    obj, _ = make_resumable(start_xrootd_server, tmp_path, monkeypatch)
+    obj.retrieve_object()
+    assert Path(obj.local_path()).read_bytes() == data
+    assert reads == list(range(0, 600, 100)) + list(range(500, 1100, 100))
+    assert not os.path.exists(f"{obj.local_path()}.xrootd-part")
+    assert not os.path.exists(obj._progress("download").path)
+
+
+def test_resumable_download_retry_resumes(start_xrootd_server, tmp_path, monkeypatch):
+    obj, data = make_resumable(start_xrootd_server, tmp_path, monkeypatch)
+    (tmp_path / "remote").mkdir()
+    (tmp_path / "remote" / "file.bin").write_bytes(data)
+    reads = interrupt_at(
+        monkeypatch, "read", 0, 300, FakeStatus(ok=False, errno=3005, message="io")
+    )
+
+    obj.retrieve_object()
+    assert Path(obj.local_path()).read_bytes() == data
+    assert reads == list(range(0, 400, 100)) + list(range(300, 1100, 100))
+
+
+def test_resumable_upload_continues_after_interruption(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    obj, data = make_resumable(start_xrootd_server, tmp_path, monkeypatch)
+    Path(obj.local_path()).write_bytes(data)
+    remote = tmp_path / "remote" / "file.bin"
+    remote.parent.mkdir()
+    remote.write_bytes(b"old")
+    writes = interrupt_at(monkeypatch, "write", 1, 700)
+
+    with pytest.raises(Interrupted):
+        obj.store_object()
+    # the old file stays in place until the upload is complete
+    assert remote.read_bytes() == b"old"
+
+    obj, _ = make_resumable(start_xrootd_server, tmp_path, monkeypatch)
+    obj.store_object()
+    assert remote.read_bytes() == data
+    assert writes == list(range(0, 800, 100)) + list(range(700, 1100, 100))
+    assert not (tmp_path / "remote" / "file.bin.xrootd-part").exists()
+    assert not os.path.exists(obj._progress("upload").path)
+
+
+@pytest.mark.parametrize("optimistic", [False, True])
+def test_store_object_probes_each_directory_once(
+    start_xrootd_server, tmp_path, monkeypatch, optimistic
+):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, optimistic_mkdir=optimistic
+        )
+    )
+    objs = [
+        provider.object(
+            query=f"root://localhost:{start_xrootd_server}/{tmp_path}/out/f{i}.txt",
+            retrieve=False,
+        )
+        for i in range(20)
+    ]
+    for obj in objs:
+        Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+        Path(obj.local_path()).write_text("x")
+    calls = count_calls(monkeypatch, "stat", "mkdir")
+
+    for obj in objs:
+        obj.store_object()
+    assert calls == (["mkdir"] if optimistic else ["stat", "mkdir"])
+    assert len(list((tmp_path / "out").iterdir())) == 20
+
+    # removing the directory makes the plugin create it again
+    calls.clear()
+    directory = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/out",
+        retrieve=False,
+    )
+    for obj in objs:
+        obj.remove()
+    directory.remove()
+    calls.clear()
+    objs[0].store_object()
+    assert calls == (["mkdir"] if optimistic else ["stat", "mkdir"])
+
+
+def test_optimistic_mkdir_existing_directory(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, optimistic_mkdir=True
+        )
+    )
+    (tmp_path / "existing").mkdir()
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/existing/f.txt",
+        retrieve=False,
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    Path(obj.local_path()).write_text("x")
+    # some servers report existing directories as an error even with MAKEPATH
+    orig_mkdir = client.FileSystem.mkdir
+
+    def strict_mkdir(self, path, *args, **kwargs):
+        if os.path.isdir(path):
+            return FakeStatus(ok=False, errno=3018, message="exists"), None
+        return orig_mkdir(self, path, *args, **kwargs)
+
+    monkeypatch.setattr(client.FileSystem, "mkdir", strict_mkdir)
+    obj.store_object()
+    assert (tmp_path / "existing" / "f.txt").read_text() == "x"
+
+
+def test_listed_directories_are_known(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    (tmp_path / "listed" / "sub").mkdir(parents=True)
+    query = f"root://localhost:{start_xrootd_server}/{tmp_path}/listed/{{name}}.txt"
+    list(provider.object(query=query, retrieve=False).list_candidate_matches())
+
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/listed/sub/f.txt",
+        retrieve=False,
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    Path(obj.local_path()).write_text("x")
+    calls = count_calls(monkeypatch, "stat", "mkdir")
+    obj.store_object()
+    assert calls == []
+
+
+def test_stat_many_groups_by_parent(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, bulk_dirlist_threshold=3
+        )
+    )
+    for name in ("clustered", "scattered1", "scattered2"):
+        (tmp_path / name).mkdir()
+    for i in range(5):
+        (tmp_path / "clustered" / f"f{i}.txt").write_text("x" * i)
+    (tmp_path / "scattered1" / "a.txt").write_text("a")
+    base = f"root://localhost:{start_xrootd_server}/{tmp_path}"
+    queries = [f"{base}/clustered/f{i}.txt" for i in range(5)] + [
+        f"{base}/clustered/missing.txt",
+        f"{base}/scattered1/a.txt",
+        f"{base}/scattered2/missing.txt",
+        f"{base}/nonexisting/a.txt",
+        f"{base}/nonexisting/b.txt",
+        f"{base}/nonexisting/c.txt",
+    ]
+    calls = count_calls(monkeypatch, "stat", "dirlist")
+
+    results = provider.stat_many(queries)
+    assert sorted(calls) == ["dirlist", "dirlist", "stat", "stat"]
+    assert [results[q].size for q in queries[:5]] == [0, 1, 2, 3, 4]
+    assert results[queries[6]].size == 1
+    assert [results[q] for q in queries[5:] if q != queries[6]] == [None] * 5
+
+    # the objects use the results without contacting the server
+    calls.clear()
+    objs = [provider.object(query=q, retrieve=False) for q in queries]
+    assert [obj.exists() for obj in objs] == [True] * 5 + [False, True] + [False] * 4
+    assert objs[3].size() == 3
+    assert asyncio.run(objs[4].managed_size()) == 4
+    assert calls == []
+
+    # uploads invalidate the result
+    Path(objs[5].local_path()).parent.mkdir(parents=True, exist_ok=True)
+    Path(objs[5].local_path()).write_text("new")
+    objs[5].store_object()
+    assert objs[5].size() == 3
+
+
+class ScriptedFailures:
+    """Makes FileSystem methods fail with scripted errnos before succeeding."""
+
+    def __init__(self, monkeypatch, method, errnos, forever=False, fake_clock=False):
+        self.calls = 0
+        self.sleeps = []
+        self.clock = 0.0
+        orig = getattr(client.FileSystem, method)
+
+        def scripted(fs, *args, **kwargs):
+            self.calls += 1
+            if forever or self.calls <= len(errnos):
+                errno = errnos[min(self.calls, len(errnos)) - 1]
+                status = FakeStatus(ok=False, errno=errno, message=f"error {errno}")
+                callback = kwargs.get("callback")
+                if callback is not None:
+                    callback(status, None, None)
+                    return FakeStatus()
+                return status, None
+            return orig(fs, *args, **kwargs)
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.clock += seconds
+
+        async def async_sleep(seconds):
+            sleep(seconds)
+
+        monkeypatch.setattr(client.FileSystem, method, scripted)
+        monkeypatch.setattr("time.sleep", sleep)
+        monkeypatch.setattr("asyncio.sleep", async_sleep)
+        if fake_clock:
+            # not for tests running an event loop, which needs the real clock
+            monkeypatch.setattr("time.monotonic", lambda: self.clock)
+
+
+def make_retry_object(server_port, tmp_path, **settings):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=server_port, **settings)
+    )
+    (tmp_path / "f.txt").write_text("abc")
+    return provider.object(
+        query=f"root://localhost:{server_port}/{tmp_path}/f.txt", retrieve=False
+    )
+
+
+def test_retry_transient_errors_with_jittered_backoff(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    obj = make_retry_object(start_xrootd_server, tmp_path, retry_tries=5)
+    failures = ScriptedFailures(monkeypatch, "stat", [3005, 3005, 3005])
+
+    assert obj.size() == 3
+    assert failures.calls == 4
+    # 0.5s, 1s and 2s, each shortened by up to half
+    for sleep, delay in zip(failures.sleeps, [0.5, 1.0, 2.0]):
+        assert delay / 2 <= sleep <= delay
+    assert len(failures.sleeps) == 3
+
+
+def test_retry_does_not_retry_fatal_errnos(start_xrootd_server, tmp_path, monkeypatch):
+    obj = make_retry_object(start_xrootd_server, tmp_path)
+    # permission denied
+    failures = ScriptedFailures(monkeypatch, "stat", [3010])
+
+    with pytest.raises(XRootDFatalException):
+        obj.size()
+    assert failures.calls == 1
+    assert failures.sleeps == []
+
+
+def test_retry_deadline(start_xrootd_server, tmp_path, monkeypatch):
+    obj = make_retry_object(
+        start_xrootd_server,
+        tmp_path,
+        retry_tries=100,
+        retry_jitter=0,
+        retry_deadline=10,
+    )
+    failures = ScriptedFailures(
+        monkeypatch, "stat", [3005], forever=True, fake_clock=True
+    )
+
+    with pytest.raises(WorkflowError):
+        obj.size()
+    # 0.5 + 1 + 2 + 4 = 7.5s, another 8s would exceed the deadline
+    assert failures.sleeps == [0.5, 1.0, 2.0, 4.0]
+
+
+def test_nested_retries_do_not_multiply(start_xrootd_server, tmp_path, monkeypatch):
+    obj = make_retry_object(start_xrootd_server, tmp_path)
+    obj = obj.provider.object(
+        query=obj.query.replace("f.txt", "new/f.txt"), retrieve=False
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    Path(obj.local_path()).write_text("x")
+    # store_object -> _makedirs -> _exists -> _stat, all retried before
+    failures = ScriptedFailures(monkeypatch, "stat", [3005], forever=True)
+
+    with pytest.raises(WorkflowError):
+        obj.store_object()
+    assert failures.calls == 3
+
+
+def test_retry_async(start_xrootd_server, tmp_path, monkeypatch):
+    obj = make_retry_object(start_xrootd_server, tmp_path)
+    failures = ScriptedFailures(monkeypatch, "stat", [3005])
+
+    assert asyncio.run(obj.managed_size()) == 3
+    assert failures.calls == 2
+    assert len(failures.sleeps) == 1
+
+
+def test_overload_recovered_by_retry_lowers_adaptive_rate(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    obj = make_retry_object(
+        start_xrootd_server,
+        tmp_path,
+        max_requests_per_second=100,
+        adaptive_rate_limit=True,
+    )
+    # the server is overloaded once, the retry succeeds
+    failures = ScriptedFailures(monkeypatch, "stat", [3024])
+
+    assert asyncio.run(obj.managed_size()) == 3
+    assert failures.calls == 2
+    throttler = obj.provider.rate_limiter(obj.query, Operation.SIZE)
+    assert throttler.rate == 50
+
+    # later requests without overloads raise the rate again
+    asyncio.run(obj.managed_size())
+    assert throttler.rate == 55
+
+
+def test_retry_policy_classification():
+    policy = RetryPolicy(no_retry_codes=frozenset([3011]))
+    retryable = WorkflowError("io error")
+    retryable.xrootd_errno = 3005
+    missing = WorkflowError("missing")
+    missing.xrootd_errno = 3011
+
+    assert policy.is_retryable(retryable)
+    assert policy.is_retryable(OSError("connection reset"))
+    assert not policy.is_retryable(missing)
+    assert not policy.is_retryable(XRootDFatalException())
+    assert policy.next_delay(retryable, attempt=3, elapsed=0) is None
+
+
+def record_copy_jobs(monkeypatch, refuse_third_party=False):
+    jobs = []
+    orig_add_job = client.CopyProcess.add_job
+    orig_run = client.CopyProcess.run
+
+    def add_job(self, source, target, **kwargs):
+        jobs.append((source, target, kwargs.get("thirdparty")))
+        self.third_party = kwargs.get("thirdparty") == "only"
+        return orig_add_job(self, source, target, **kwargs)
+
+    def run(self, *args, **kwargs):
+        if refuse_third_party and getattr(self, "third_party", False):
+            refused = FakeStatus(ok=False, errno=3013, message="TPC not supported")
+            return FakeStatus(), [{"status": refused}]
+        return orig_run(self, *args, **kwargs)
+
+    monkeypatch.setattr(client.CopyProcess, "add_job", add_job)
+    monkeypatch.setattr(client.CopyProcess, "run", run)
+    return jobs
+
+
+@pytest.mark.parametrize("refuse_third_party", [False, True])
+def test_copy_between_servers(
+    start_xrootd_server, second_xrootd_server, tmp_path, monkeypatch, refuse_third_party
+):
+    if not refuse_third_party and shutil.which("xrdcp") is None:
+        pytest.skip("third-party copies need xrdcp on the servers")
+    provider = make_provider(StorageProviderSettings())
+    (tmp_path / "site1").mkdir()
+    (tmp_path / "site1" / "data.txt").write_text("payload")
+    source = f"root://localhost:{start_xrootd_server}/{tmp_path}/site1/data.txt"
+    target = f"root://localhost:{second_xrootd_server}/{tmp_path}/site2/data.txt"
+    jobs = record_copy_jobs(monkeypatch, refuse_third_party)
+
+    provider.copy(source, target)
+
+    assert (tmp_path / "site2" / "data.txt").read_text() == "payload"
+    assert jobs[0][2] == "only"
+    if refuse_third_party:
+        # downloaded to and uploaded from the local prefix
+        assert len(jobs) == 3
+        assert jobs[1][0] == jobs[0][0] and jobs[2][1] == jobs[0][1]
+        assert jobs[1][1] == jobs[2][0]
+        assert not os.path.exists(jobs[1][1])
+    else:
+        assert len(jobs) == 1
+
+
+def test_copy_missing_source_does_not_fall_back(
+    start_xrootd_server, second_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(StorageProviderSettings())
+    jobs = record_copy_jobs(monkeypatch)
+
+    with pytest.raises(XRootDFatalException):
+        provider.copy(
+            f"root://localhost:{start_xrootd_server}/{tmp_path}/missing.txt",
+            f"root://localhost:{second_xrootd_server}/{tmp_path}/copy/missing.txt",
+        )
+    # no download through the local prefix after the third-party copy failed
+    assert [thirdparty for _, _, thirdparty in jobs] == ["only"]
+
+
+def test_copy_without_third_party(
+    start_xrootd_server, second_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(StorageProviderSettings(third_party_copy=False))
+    (tmp_path / "data.txt").write_text("payload")
+    jobs = record_copy_jobs(monkeypatch)
+
+    provider.copy(
+        f"root://localhost:{start_xrootd_server}/{tmp_path}/data.txt",
+        f"root://localhost:{second_xrootd_server}/{tmp_path}/copy/data.txt",
+    )
+
+    assert (tmp_path / "copy" / "data.txt").read_text() == "payload"
+    assert [thirdparty for _, _, thirdparty in jobs] == [None, None]
+
+
+def test_node_cache_concurrent_retrievers(tmp_path):
+    cache = NodeCache(str(tmp_path / "cache"), max_bytes=1000)
+    downloads = []
+
+    def download(path):
+        downloads.append(path)
+        time.sleep(0.1)
+        Path(path).write_bytes(b"x" * 100)
+
+    threads = [
+        threading.Thread(
+            target=cache.retrieve,
+            args=("key", str(tmp_path / f"job{i}" / "data.bin"), download),
+        )
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(downloads) == 1
+    for i in range(4):
+        local = tmp_path / f"job{i}" / "data.bin"
+        assert local.read_bytes() == b"x" * 100
+        assert local.stat().st_nlink == 5
+
+
+def test_node_cache_eviction(tmp_path):
+    cache = NodeCache(str(tmp_path / "cache"), max_bytes=250)
+    for i, key in enumerate(["a", "b", "c"]):
+        local = tmp_path / f"{key}.bin"
+        cache.retrieve(key, str(local), lambda path: Path(path).write_bytes(b"x" * 100))
+        os.utime(cache._path(key), (i, i))
+        if key == "a":
+            # using an entry marks it as recently used
+            cache.retrieve(key, str(local), lambda path: pytest.fail("downloaded"))
+            os.utime(cache._path(key), (10, 10))
+
+    assert os.path.exists(cache._path("a"))
+    assert not os.path.exists(cache._path("b"))
+    assert os.path.exists(cache._path("c"))
+    # evicted entries take their lock file with them
+    assert os.path.exists(cache._path("a") + ".lock")
+    assert not os.path.exists(cache._path("b") + ".lock")
+    # evicted entries stay available at their local paths
+    assert (tmp_path / "b.bin").read_bytes() == b"x" * 100
+
+
+def test_node_cache_removes_orphaned_locks(tmp_path):
+    cache = NodeCache(str(tmp_path / "cache"), max_bytes=1000)
+
+    def failing_download(path):
+        Path(path).write_bytes(b"partial")
+        raise WorkflowError("download failed")
+
+    with pytest.raises(WorkflowError):
+        cache.retrieve("failed", str(tmp_path / "failed.bin"), failing_download)
+    # the partial download is removed right away
+    assert os.listdir(tmp_path / "cache") == [
+        os.path.basename(cache._path("failed")) + ".lock"
+    ]
+
+    cache.evict()
+    assert os.listdir(tmp_path / "cache") == []
+
+    # partial downloads left behind by killed processes are removed as well,
+    # unless they are still running
+    for key in ("killed", "running"):
+        Path(cache._path(key) + ".download").write_bytes(b"partial")
+    Path(cache._path("killed") + ".download" + PARTIAL_SUFFIX).write_bytes(b"p")
+    with NodeCache._lock(cache._path("running")):
+        cache.evict()
+        assert sorted(os.listdir(tmp_path / "cache")) == sorted(
+            os.path.basename(cache._path("running")) + suffix
+            for suffix in (".download", ".lock")
+        )
+
+
+def test_retrieve_object_node_cache(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            node_cache_dir=str(tmp_path / "cache"),
+        )
+    )
+    (tmp_path / "data.bin").write_bytes(b"first")
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/data.bin",
+        retrieve=False,
+    )
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    downloads = []
+    orig_download = obj._download
+
+    def counting_download(local_path, stat_info, batch=True):
+        downloads.append(local_path)
+        return orig_download(local_path, stat_info, batch)
+
+    monkeypatch.setattr(obj, "_download", counting_download)
+
+    obj.retrieve_object()
+    os.remove(obj.local_path())
+    obj.retrieve_object()
+    assert len(downloads) == 1
+    assert Path(obj.local_path()).read_bytes() == b"first"
+
+    # a changed remote file is a new cache entry
+    (tmp_path / "data.bin").write_bytes(b"second")
+    obj.retrieve_object()
+    assert len(downloads) == 2
+    assert Path(obj.local_path()).read_bytes() == b"second"
+
+
+def make_tree(root: Path, layout: str) -> tuple[dict, int]:
+    files = {}
+    if layout == "wide":
+        for i in range(50):
+            files[f"file{i}.txt"] = f"content {i}"
+        leaves = 1
+    else:
+        path = ""
+        for depth in range(8):
+            path += f"level{depth}/"
+            files[f"{path}file.txt"] = f"depth {depth}"
+        files["top.txt"] = "top"
+        (root / "empty").mkdir(parents=True)
+        leaves = 2
+    for rel_path, content in files.items():
+        (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel_path).write_text(content)
+    return files, leaves
+
+
+def read_tree(root: Path) -> dict:
+    return {
+        str(path.relative_to(root)): path.read_text()
+        for path in root.rglob("*")
+        if path.is_file()
+    }
+
+
+@pytest.mark.parametrize("layout", ["wide", "deep"])
+def test_directory_store_and_retrieve(
+    start_xrootd_server, tmp_path, monkeypatch, layout
+):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            directory_transfer_batch_size=7,
+        )
+    )
+    remote = tmp_path / "remote" / "out"
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}",
+        retrieve=False,
+    )
+    local = Path(obj.local_path())
+    shutil.rmtree(local, ignore_errors=True)
+    files, leaves = make_tree(local, layout)
+
+    calls = count_calls(monkeypatch, "mkdir")
+    obj.store_object()
+    assert calls.count("mkdir") == leaves
+    assert read_tree(remote) == files
+    if layout == "deep":
+        assert (remote / "empty").is_dir()
+
+    assert obj.size() == sum(len(content) for content in files.values())
+    (remote / "top.txt" if layout == "deep" else remote / "file0.txt").touch()
+    os.utime(remote, (0, 0))
+    assert obj.mtime() == max(int(path.stat().st_mtime) for path in remote.rglob("*"))
+
+    shutil.rmtree(local)
+    obj.retrieve_object()
+    assert read_tree(local) == files
+    if layout == "deep":
+        assert (local / "empty").is_dir()
+
+
+def test_directory_managed_size(start_xrootd_server, tmp_path):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    make_tree(tmp_path / "tree", "deep")
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/tree",
+        retrieve=False,
+    )
+    assert asyncio.run(obj.managed_size()) == len("top") + sum(
+        len(f"depth {depth}") for depth in range(8)
+    )
+
+
+def make_removable_tree(server_port, tmp_path, **settings):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=server_port, **settings)
+    )
+    tree = tmp_path / "tree"
+    files, _ = make_tree(tree, "deep")
+    make_tree(tree / "wide", "wide")
+    obj = provider.object(
+        query=f"root://localhost:{server_port}/{tree}", retrieve=False
+    )
+    return obj, tree, len(files) + 50
+
+
+def test_remove_directory_recursively(start_xrootd_server, tmp_path, monkeypatch):
+    obj, tree, n_files = make_removable_tree(start_xrootd_server, tmp_path)
+    n_dirs = sum(1 for path in tree.rglob("*") if path.is_dir()) + 1
+    calls = count_calls(monkeypatch, "dirlist", "rm", "rmdir", with_paths=True)
+
+    obj.remove()
+
+    assert not tree.exists()
+    methods = [method for method, _ in calls]
+    assert methods.count("dirlist") == n_dirs
+    assert methods.count("rm") == n_files
+    assert methods.count("rmdir") == n_dirs
+    # all files go first, and directories are only removed once empty
+    assert methods.index("rmdir") > max(
+        i for i, method in enumerate(methods) if method == "rm"
+    )
+    removed_dirs = [path for method, path in calls if method == "rmdir"]
+    for i, path in enumerate(removed_dirs):
+        assert not any(later.startswith(path + "/") for later in removed_dirs[i + 1 :])
+    assert removed_dirs[-1] == str(tree)
+
+
+def test_remove_directory_dry_run(start_xrootd_server, tmp_path, monkeypatch):
+    obj, tree, n_files = make_removable_tree(
+        start_xrootd_server,
+        tmp_path,
+        remove_dry_run=True,
+        metadata_cache_ttl=3600,
+        metadata_cache_path=str(tmp_path / "metadata.sqlite"),
+    )
+    size = obj.size()
+    calls = count_calls(monkeypatch, "rm", "rmdir", with_paths=True)
+
+    removed = obj._remove_tree()
+    obj.remove()
+
+    assert calls == []
+    assert (
+        len(removed)
+        == n_files + sum(1 for path in tree.rglob("*") if path.is_dir()) + 1
+    )
+    assert (tree / "level0" / "file.txt").exists()
+
+    # the cached metadata of the tree survives as well
+    calls = count_calls(monkeypatch, "stat", "dirlist")
+    assert obj.size() == size
+    assert calls == []
+
+
+def test_remove_directory_max_entries(start_xrootd_server, tmp_path, monkeypatch):
+    obj, tree, _ = make_removable_tree(
+        start_xrootd_server, tmp_path, remove_max_entries=10
+    )
+    calls = count_calls(monkeypatch, "rm", "rmdir", with_paths=True)
+    with pytest.raises(WorkflowError, match="remove_max_entries"):
+        obj.remove()
+    assert calls == []
+    assert tree.exists()
+
+
+@pytest.mark.parametrize("size", [0, 1000, 2000])
+def test_small_file_upload(start_xrootd_server, tmp_path, monkeypatch, size):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, small_file_threshold=1024
+        )
+    )
+    remote = tmp_path / "new" / "dir" / "small.bin"
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{remote}", retrieve=False
+    )
+    data = os.urandom(size)
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    Path(obj.local_path()).write_bytes(data)
+    jobs = record_copy_jobs(monkeypatch)
+    calls = count_calls(monkeypatch, "stat", "mkdir")
+
+    obj.store_object()
+
+    assert remote.read_bytes() == data
+    if size < 1024:
+        # no copy process and no separate directory check
+        assert jobs == [] and calls == []
+        assert provider._is_known_directory(obj._endpoint, str(remote.parent))
+    else:
+        assert len(jobs) == 1
+
+
+def test_small_file_upload_reuses_handle(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost", port=start_xrootd_server, small_file_threshold=1024
+        )
+    )
+    handles = []
+    orig_init = client.File.__init__
+
+    def counting_init(self, *args, **kwargs):
+        handles.append(self)
+        orig_init(self, *args, **kwargs)
+
+    monkeypatch.setattr(client.File, "__init__", counting_init)
+    for i in range(3):
+        obj = provider.object(
+            query=f"root://localhost:{start_xrootd_server}/{tmp_path}/f{i}.txt",
+            retrieve=False,
+        )
+        Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+        Path(obj.local_path()).write_text(f"file {i}")
+        obj.store_object()
+        assert (tmp_path / f"f{i}.txt").read_text() == f"file {i}"
+    assert len(handles) == 1
+
+
+def make_prefetching(server_port, tmp_path, monkeypatch, n_files=3, **settings):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=server_port, **settings)
+    )
+    queries = []
+    for i in range(n_files):
+        (tmp_path / f"f{i}.bin").write_bytes(bytes([i]) * 100)
+        queries.append(f"root://localhost:{server_port}/{tmp_path}/f{i}.bin")
+        obj = provider.object(query=queries[-1], retrieve=False)
+        Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    downloads = []
+    release = threading.Event()
+    orig_download = StorageObject._download
+
+    def blocking_download(self, local_path, stat_info, batch=True):
+        downloads.append(self.filename)
+        assert release.wait(10)
+        return orig_download(self, local_path, stat_info, batch)
+
+    monkeypatch.setattr(StorageObject, "_download", blocking_download)
+    return provider, queries, downloads, release
+
+
+def test_prefetch_dedups_in_flight_downloads(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider, queries, downloads, release = make_prefetching(
+        start_xrootd_server, tmp_path, monkeypatch, prefetch_max_bytes=1000
+    )
+    assert provider.prefetch(queries[:1]) == 1
+    assert provider.prefetch(queries[:1]) == 1
+    obj = provider.object(query=queries[0], retrieve=False)
+    retriever = threading.Thread(target=obj.retrieve_object)
+    retriever.start()
+    time.sleep(0.1)
+    # retrieving waits for the prefetch instead of downloading again
+    assert downloads == ["f0.bin"]
+    release.set()
+    retriever.join()
+
+    assert downloads == ["f0.bin"]
+    assert Path(obj.local_path()).read_bytes() == bytes([0]) * 100
+    assert provider._prefetcher.reserved == 0
+
+
+def test_prefetch_byte_budget(start_xrootd_server, tmp_path, monkeypatch):
+    provider, queries, downloads, release = make_prefetching(
+        start_xrootd_server, tmp_path, monkeypatch, prefetch_max_bytes=250
+    )
+    release.set()
+    assert provider.prefetch(queries) == 2
+    entries = list(provider._prefetcher._entries.values())
+    for entry in entries:
+        entry.future.result()
+    assert sum(os.path.getsize(entry.path) for entry in entries) <= 250
+
+    # retrieving a prefetched file frees its share of the budget
+    obj = provider.object(query=queries[0], retrieve=False)
+    obj.retrieve_object()
+    assert provider._prefetcher.reserved == 100
+    assert provider.prefetch(queries[2:]) == 1
+    last = provider.object(query=queries[2], retrieve=False)
+    provider._prefetcher._entries[str(last.url)].future.result()
+    assert len(downloads) == 3
+    provider.cancel_prefetch()
+
+
+def test_prefetch_cancel(start_xrootd_server, tmp_path, monkeypatch):
+    provider, queries, downloads, release = make_prefetching(
+        start_xrootd_server,
+        tmp_path,
+        monkeypatch,
+        prefetch_max_bytes=1000,
+        prefetch_workers=1,
+    )
+    assert provider.prefetch(queries) == 3
+    time.sleep(0.1)
+    entries = list(provider._prefetcher._entries.values())
+    provider.cancel_prefetch()
+    release.set()
+    provider._prefetcher._executor.shutdown(wait=True)
+
+    # only the running download went ahead, and its file was discarded
+    assert downloads == ["f0.bin"]
+    assert not any(os.path.exists(entry.path) for entry in entries)
+    assert provider._prefetcher.reserved == 0
+
+    obj = provider.object(query=queries[1], retrieve=False)
+    obj.retrieve_object()
+    assert downloads == ["f0.bin", "f1.bin"]
+
+
+def test_prefetch_outdated(start_xrootd_server, tmp_path, monkeypatch):
+    provider, queries, downloads, release = make_prefetching(
+        start_xrootd_server, tmp_path, monkeypatch, prefetch_max_bytes=1000
+    )
+    release.set()
+    provider.prefetch(queries[:1])
+    (tmp_path / "f0.bin").write_bytes(b"changed")
+
+    obj = provider.object(query=queries[0], retrieve=False)
+    obj.retrieve_object()
+    assert Path(obj.local_path()).read_bytes() == b"changed"
+    assert len(downloads) == 2
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_prefetch_does_not_delay_retrieval(
+    start_xrootd_server, tmp_path, monkeypatch, batch_size
+):
+    jobs = []
+
+    class SlowCopyProcess(client.CopyProcess):
+        def add_job(self, source, target, **kwargs):
+            self.n_jobs = getattr(self, "n_jobs", 0) + 1
+            return super().add_job(source, target, **kwargs)
+
+        def run(self, *args, **kwargs):
+            jobs.append(self.n_jobs)
+            time.sleep(0.3)
+            return super().run(*args, **kwargs)
+
+    monkeypatch.setattr(client, "CopyProcess", SlowCopyProcess)
+    provider = make_provider(
+        StorageProviderSettings(
+            host="localhost",
+            port=start_xrootd_server,
+            transfer_batch_size=batch_size,
+            prefetch_max_bytes=10000,
+            prefetch_workers=8,
+        )
+    )
+    queries = []
+    for i in range(9):
+        (tmp_path / f"f{i}.bin").write_bytes(bytes([i]) * 100)
+        queries.append(f"root://localhost:{start_xrootd_server}/{tmp_path}/f{i}.bin")
+    assert provider.prefetch(queries[:8]) == 8
+
+    obj = provider.object(query=queries[8], retrieve=False)
+    Path(obj.local_path()).parent.mkdir(parents=True, exist_ok=True)
+    start = time.monotonic()
+    obj.retrieve_object()
+    elapsed = time.monotonic() - start
+    assert Path(obj.local_path()).read_bytes() == bytes([8]) * 100
+    # the retrieval takes about one copy and does not wait for prefetches
+    assert elapsed < 0.6
+    for entry in list(provider._prefetcher._entries.values()):
+        entry.future.result()
+    # prefetches run in copy processes of their own
+    assert jobs == [1] * 9
+    provider.cancel_prefetch()
+
+
+def run_in_threads(func, n=8):
+    results = [None] * n
+
+    def run(i):
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.parametrize("method", ["stat", "dirlist"])
+def test_concurrent_identical_requests_are_coalesced(
+    start_xrootd_server, tmp_path, monkeypatch, method
+):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    (tmp_path / "a.txt").write_text("abc")
+    path = str(tmp_path / "a.txt") if method == "stat" else str(tmp_path)
+    query = f"root://localhost:{start_xrootd_server}/{path}"
+    calls = count_calls(monkeypatch, method, delay=0.2)
+
+    def request():
+        # every thread uses its own storage object, as Snakemake does
+        obj = provider.object(query=query, retrieve=False)
+        if method == "stat":
+            return obj._stat(obj.url.path_with_params).size
+        return [entry.name for entry in obj._dirlist(obj.url.path_with_params)]
+
+    results = run_in_threads(request)
+    assert calls == [method]
+    assert results == [3 if method == "stat" else ["a.txt"]] * 8
+
+    # finished requests are not remembered
+    request()
+    assert calls == [method] * 2
+
+
+def test_requests_with_different_credentials_are_not_coalesced(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    (tmp_path / "a.txt").write_text("abc")
+    query = f"root://localhost:{start_xrootd_server}/{tmp_path}/a.txt"
+    calls = count_calls(monkeypatch, "stat", delay=0.2)
+    tokens = iter(range(8))
+    lock = threading.Lock()
+
+    def request():
+        with lock:
+            token = next(tokens) % 2
+        obj = provider.object(query=f"{query}?authz=token{token}", retrieve=False)
+        return obj._stat(obj.url.path_with_params).size
+
+    assert run_in_threads(request) == [3] * 8
+    # one request per token
+    assert calls == ["stat"] * 2
+
+
+def test_coalesced_requests_share_errors(start_xrootd_server, tmp_path, monkeypatch):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    obj = provider.object(
+        query=f"root://localhost:{start_xrootd_server}/{tmp_path}/missing.txt",
+        retrieve=False,
+    )
+    calls = count_calls(monkeypatch, "stat", delay=0.2)
+
+    results = run_in_threads(lambda: obj._stat(obj.url.path_with_params))
+    assert calls == ["stat"]
+    assert all(isinstance(result, XRootDFatalException) for result in results)
+
+    # callers interpret the shared status themselves
+    results = run_in_threads(
+        lambda: obj._stat(obj.url.path_with_params, allow_missing=True), n=2
+    )
+    assert results == [None, None]
+    assert calls == ["stat"] * 2
+
+
+def test_concurrent_async_requests_are_coalesced(
+    start_xrootd_server, tmp_path, monkeypatch
+):
+    provider = make_provider(
+        StorageProviderSettings(host="localhost", port=start_xrootd_server)
+    )
+    (tmp_path / "a.txt").write_text("abc")
+    objs = [
+        provider.object(
+            query=f"root://localhost:{start_xrootd_server}/{tmp_path}/a.txt",
+            retrieve=False,
+        )
+        for _ in range(8)
+    ]
+    calls = count_calls(monkeypatch, "stat")
+
+    async def stat_all():
+        return await asyncio.gather(
+            *(obj._stat_async(obj.url.path_with_params) for obj in objs)
+        )
+
+    assert [stat.size for stat in asyncio.run(stat_all())] == [3] * 8
+    assert calls == ["stat"]